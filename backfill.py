@@ -0,0 +1,176 @@
+"""Repository-wide scan for stale auto-translations, and a parallel backfill job.
+A dual file is stale if its last revision is made by the bot, its source is revised later by human,
+and the source content differs from what was last translated (see TestMonitor.record_translated).
+The job works in its own clone, translates on a bounded parallel pool and makes one bot commit per batch.
+A checkpoint file allows an interrupted job to resume.
+    python backfill.py --dry-run                 # only list the stale files
+    python backfill.py --batch-size 20 --jobs 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import yaml
+from logger import _logger
+from gitutils import git_clone, git_pull, git_push, get_commit_list, get_last_commits, get_blob_hashes, get_file_last_commit_author
+from bot import TestMonitor, dual
+
+
+def find_stale(path, bot_author, translated_hashes):
+    """Scan all en/ and zh-hans/ pairs. Returns the stale jobs [(lang, source, dual), ...] with repo-relative paths"""
+
+    last_commits = get_last_commits(path=path)
+    blob_hashes = get_blob_hashes(path=path)
+    stale = []
+    for fpath in sorted(blob_hashes):
+        if not fpath.endswith('.md') or fpath.endswith('/SUMMARY.md'):
+            continue
+        fpath_dual = dual(fpath)['name']
+        if fpath_dual not in blob_hashes or fpath not in last_commits or fpath_dual not in last_commits:
+            continue
+        src, tgt = last_commits[fpath], last_commits[fpath_dual]
+        if src['author'] == bot_author or tgt['author'] != bot_author: # fpath is not the source of a bot translation
+            continue
+        if src['order'] >= tgt['order']: # the source is not revised after the translation
+            continue
+        if translated_hashes.get(fpath) == blob_hashes[fpath]: # this content is translated already
+            continue
+        stale.append((dual(fpath)['trans'], fpath, fpath_dual))
+    return stale
+
+
+class Backfill(object):
+    """Retranslate the stale dual files of a wiki"""
+
+    def __init__(self, args, workdir='backfill_area', batch_size=20, jobs=4, build=True):
+        self.args = dict(args, testarea=dict(args['testarea'], relpath=workdir))
+        self.args['translator'] = dict(args.get('translator', {}), concurrency=jobs)
+        self.path = workdir
+        self.batch_size = batch_size
+        self.build = build
+        self.monitor = TestMonitor(self.args) # reuses the translator pool, the build and the state files of the bot
+
+    @property
+    def checkpoint(self):
+        return self.monitor.state_file('.backfill_checkpoint.json')
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def save_checkpoint(self, pending):
+        with open(self.checkpoint, 'w') as fw:
+            json.dump({'pending': pending}, fw, indent=1)
+
+    async def prepare(self):
+        args = self.args
+        if not os.path.exists(self.path):
+            await asyncio.to_thread(git_clone, git_remote=args['testarea']['git_remote'], setup_dir=self.path, args=args)
+        else:
+            await asyncio.to_thread(git_pull, path=self.path, args=args)
+        self.monitor.init_translators()
+        os.makedirs(self.monitor.state_dir, exist_ok=True)
+
+    def scan(self, resume=False):
+        checkpoint = self.load_checkpoint() if resume else None
+        if checkpoint is not None:
+            _logger.info(f"Resume from checkpoint: {len(checkpoint['pending'])} file(s) pending")
+            return [(tuple(lang), src, tgt) for lang, src, tgt in checkpoint['pending']]
+        return find_stale(self.path, self.args['bot']['author'], self.monitor.load_translated_hashes())
+
+    def still_wanted(self, job):
+        """Whether a job still holds after a pull (see TestMonitor.retry_trans_queue): the source exists and
+        the dual file is still maintained by the bot
+        """
+        _, src, tgt = job
+        if not os.path.exists(os.path.join(self.path, src)):
+            _logger.warning(f'Backfill of {tgt} is dropped: {src} is removed')
+            return False
+        if not os.path.exists(os.path.join(self.path, tgt)):
+            _logger.warning(f'Backfill of {tgt} is dropped: the file is removed')
+            return False
+        if get_file_last_commit_author(path=self.path, fpath=tgt)[0] != self.args['bot']['author']:
+            _logger.warning(f'Backfill of {tgt} is dropped: the file is now maintained by human')
+            return False
+        return True
+
+    async def run(self, resume=False, dry_run=False):
+        try:
+            return await self.backfill(resume=resume, dry_run=dry_run)
+        finally:
+            self.monitor.close_translators()
+
+    async def backfill(self, resume=False, dry_run=False):
+        args, path = self.args, self.path
+        await self.prepare()
+        stale = self.scan(resume=resume)
+        _logger.info('Stale translations ({n}):\n{files}'.format(n=len(stale), files='\n'.join(f'{s} -> {d}' for _, s, d in stale)))
+        if dry_run or len(stale) == 0:
+            return stale
+        self.save_checkpoint(stale)
+
+        n_batch = (len(stale) + self.batch_size - 1) // self.batch_size
+        failed = [] # jobs not translated so far, kept in the checkpoint
+        for ibatch in range(n_batch):
+            batch = stale[ibatch*self.batch_size:(ibatch+1)*self.batch_size]
+            await asyncio.to_thread(git_pull, path=path, args=args)
+            ## The scan or the checkpoint may be outdated: never overwrite a file that human took over meanwhile
+            batch = await asyncio.to_thread(lambda: [job for job in batch if self.still_wanted(job)])
+            if len(batch) == 0:
+                self.save_checkpoint(failed + stale[(ibatch+1)*self.batch_size:])
+                continue
+            texts = await self.monitor.translate_all([(lang, os.path.join(path, src), os.path.join(path, tgt)) for lang, src, tgt in batch])
+            done = []
+            for (lang, src, tgt), text in zip(batch, texts):
+                if text is None: # backend unavailable: keep it pending
+                    failed.append((lang, src, tgt))
+                    continue
+                with open(os.path.join(path, tgt), 'w') as fw:
+                    fw.write(text)
+                done.append((lang, src, tgt))
+            if len(done) == 0:
+                self.save_checkpoint(failed + stale[(ibatch+1)*self.batch_size:])
+                _logger.warning(f'Translation backend unavailable. Stop here with {len(failed)} file(s) pending; rerun with --resume later')
+                return stale
+            self.monitor.record_translated([os.path.join(path, src) for _, src, _ in done])
+            if self.build and not (await self.monitor.build())[0]:
+                raise RuntimeError(f'Cannot build after backfilling batch {ibatch+1}/{n_batch}. Left uncommitted in {path}')
+            await asyncio.to_thread(
+                git_push, path=path, args=args,
+                msg=args['bot']['commit_prefix']+f'Backfill stale auto-translations (batch {ibatch+1}/{n_batch})',
+            )
+            self.save_checkpoint(failed + stale[(ibatch+1)*self.batch_size:])
+            _logger.info(f"Batch {ibatch+1}/{n_batch} pushed as {get_commit_list(path=path, n_show=1)[0][:8]}: {len(done)} file(s)")
+        if len(failed) > 0:
+            _logger.warning('Not translated, rerun with --resume later:\n' + '\n'.join(f'{s} -> {d}' for _, s, d in failed))
+        else:
+            os.remove(self.checkpoint)
+        return stale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find and retranslate stale auto-translated files')
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--repo', help='name of the repository, in multi-repository mode')
+    parser.add_argument('--workdir', default='backfill_area', help='working clone used by the job')
+    parser.add_argument('--batch-size', type=int, default=20, help='files per bot commit')
+    parser.add_argument('--jobs', type=int, default=4, help='files translated in parallel')
+    parser.add_argument('--no-build', action='store_true', help='do not check the gitbook build before each commit')
+    parser.add_argument('--resume', action='store_true', help='resume from the checkpoint of an interrupted job')
+    parser.add_argument('--dry-run', action='store_true', help='only list the stale files')
+    opts = parser.parse_args()
+
+    with open(opts.config) as f, open('.mail_config.yml') as _f:
+        args = yaml.safe_load(f)
+        args['mail'] = yaml.safe_load(_f)
+    if 'repos' in args:
+        from daemon import repo_args
+        repo = [r for r in args['repos'] if r['name'] == opts.repo]
+        if len(repo) == 0:
+            raise SystemExit(f"Please choose a repository with --repo: {', '.join(r['name'] for r in args['repos'])}")
+        args = repo_args(args, repo[0])
+
+    job = Backfill(args, workdir=opts.workdir, batch_size=opts.batch_size, jobs=opts.jobs, build=not opts.no_build)
+    asyncio.run(job.run(resume=opts.resume, dry_run=opts.dry_run))
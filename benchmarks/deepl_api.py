@@ -0,0 +1,52 @@
+"""Throughput benchmark of the DeepL API backend against the local mock server (runs offline).
+    python benchmarks/deepl_api.py --n-pages 20 --latency 0.05
+"""
+import argparse
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+from logger import _logger
+from mockdeepl import MockDeepLServer
+from translator import DeepLTranslator
+
+
+def make_page(n_paragraphs=40):
+    """A synthetic wiki page with headings, paragraphs and code blocks"""
+    blocks = ['# A synthetic page']
+    for i in range(n_paragraphs):
+        blocks.append(f'## Section {i}')
+        blocks.append(f'The detector response in section {i} is calibrated with the [tag-and-probe](../tnp/README.md) method. ' * 3)
+        if i % 5 == 0:
+            blocks.append('```bash\ncmsRun run_cfg.py\n```')
+    return '\n\n'.join(blocks)
+
+
+def run(n_pages, latency, pool_size, batch_size):
+    srv = MockDeepLServer(latency=latency).start()
+    try:
+        trans = DeepLTranslator(
+            use_api=True, api_configs={'url': srv.url, 'pool_size': pool_size, 'batch_size': batch_size},
+            guard_configs={'rate': 1e3, 'burst': 1e3, 'max_rate': 1e3}, # measure the backend, not the rate limiter
+            make_banner=False, do_post=False,
+        )
+        pages = [make_page() for _ in range(n_pages)]
+        n_chars = sum(len(p) for p in pages)
+        start = time.perf_counter()
+        for page in pages:
+            trans.launch(page, target_lang='zh', source_lang='en')
+        elapsed = time.perf_counter() - start
+        trans.api_client.close()
+    finally:
+        srv.stop()
+    print(f'pool_size={pool_size:2d} batch_size={batch_size:2d}: {n_pages} pages, {srv.n_requests:4d} requests, '
+          f'{elapsed:6.2f} s, {n_chars/elapsed/1000:8.1f} kchar/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DeepL API backend on a local mock server')
+    parser.add_argument('--n-pages', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='mock latency per request (s)')
+    opts = parser.parse_args()
+    _logger.setLevel(logging.INFO)
+    for pool_size, batch_size in [(1, 1), (1, 50), (4, 10), (4, 50), (8, 50)]:
+        run(opts.n_pages, opts.latency, pool_size, batch_size)
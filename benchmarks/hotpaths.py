@@ -0,0 +1,185 @@
+"""Benchmarks of the translator and SummaryParser hot paths on synthetic wiki corpora of increasing size.
+Each run is appended to .benchmarks/history.jsonl with the current git commit, so that results can be tracked across commits.
+    python benchmarks/hotpaths.py                    # run all, compare with the last run of another commit
+    python benchmarks/hotpaths.py -k summary --sizes 100 1000 4000
+"""
+import argparse
+import atexit
+import json
+import logging
+import math
+import os, sys, shutil, subprocess, tempfile, time
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from logger import _logger
+from translator import DeepLTranslator, fix_broken_mkdown, add_spaces_zh
+from summaryparser import SummaryParser as sp
+
+HISTORY = os.path.join(ROOT, '.benchmarks', 'history.jsonl')
+
+## ================================================================================
+## Synthetic corpora. 'n' is the number of repeated elements (code blocks, table rows, links).
+## SUMMARY.md benchmarks use 10*n entries, i.e. thousands of entries at the default sizes
+## ================================================================================
+def page_code_blocks(n):
+    blocks = ['# Many code blocks']
+    for i in range(n):
+        blocks.append(f'Step {i}: run the following command and check the output of `step{i}`.')
+        blocks.append(f'```bash\ncmsrel CMSSW_12_4_{i}\ncd CMSSW_12_4_{i}/src && cmsenv | grep {i}\n```')
+    return '\n\n'.join(blocks)
+
+def page_long_table(n):
+    rows = ['# A long table', '', '| Sample | Cross section (pb) | Events | Link |', '| --- | --- | --- | --- |']
+    for i in range(n):
+        rows.append(f'| TTTo2L2Nu_{i} | {87.3+i:.1f} | {1000*i} | [DAS](https://cmsweb.cern.ch/das/request?input=ttbar{i}) |')
+    return '\n'.join(rows)
+
+def page_dense_links(n):
+    lines = ['# Dense links']
+    for i in range(0, n, 5):
+        lines.append(' '.join(f'See [note {j}](../notes/note_{j}.md) and ![fig {j}](figs/fig_{j}.png).' for j in range(i, i+5)))
+    return '\n\n'.join(lines)
+
+def page_zh(n):
+    return '\n\n'.join(f'第{i}节：使用CMSSW_12_4_{i}运行ttH分析，并检查JEC与b-tagging的系统误差。' for i in range(n))
+
+def summary_text(n, lang):
+    lines = ['# Summary', '']
+    for i in range(n):
+        indent = '  ' * (i % 3)
+        title = f'Section {i}' if lang == 'en' else f'第{i}节'
+        lines.append(f'{indent}* [{title}](part{i//50}/section_{i}.md)')
+    return '\n'.join(lines) + '\n'
+
+def summary_patch(n, n_new):
+    """A -U0 patch on en/SUMMARY.md that appends 'n_new' entries and renames one"""
+    lines = [
+        'diff --git a/en/SUMMARY.md b/en/SUMMARY.md', '--- a/en/SUMMARY.md', '+++ b/en/SUMMARY.md',
+        '@@ -3 +3 @@', '-* [Section 0](part0/section_0.md)', '+* [Section zero](part0/section_0.md)',
+        f'@@ -{n+2} +{n+3},{n_new} @@',
+    ]
+    lines += [f'+* [New section {i}](new/section_{i}.md)' for i in range(n_new)]
+    return '\n'.join(lines) + '\n'
+
+## ================================================================================
+## Benchmarks: each takes the size n and returns a function to time
+## ================================================================================
+def stub_translator():
+    trans = DeepLTranslator(make_banner=True, do_post=True, support_mkdown=True)
+    trans.launch_backend = lambda text: text # stubbed backend: echo
+    return trans
+
+def bench_launch_code_blocks(n):
+    trans, text = stub_translator(), page_code_blocks(n)
+    return lambda: trans.launch(text, target_lang='zh', source_lang='en')
+
+def bench_launch_table(n):
+    trans, text = stub_translator(), page_long_table(n)
+    return lambda: trans.launch(text, target_lang='zh', source_lang='en')
+
+def bench_fix_broken_mkdown_links(n):
+    text = page_dense_links(n)
+    return lambda: fix_broken_mkdown(text)
+
+def bench_fix_broken_mkdown_table(n):
+    text = page_long_table(n)
+    return lambda: fix_broken_mkdown(text)
+
+def bench_add_spaces_zh(n):
+    text = page_zh(n)
+    return lambda: add_spaces_zh(text)
+
+def _summary_dir(n):
+    tmpdir = tempfile.mkdtemp(prefix='bench_summary_')
+    atexit.register(shutil.rmtree, tmpdir, True)
+    for lang in ('en', 'zh-hans'):
+        os.makedirs(os.path.join(tmpdir, lang))
+        with open(os.path.join(tmpdir, lang, 'SUMMARY.md'), 'w') as fw:
+            fw.write(summary_text(n, 'en' if lang == 'en' else 'zh'))
+    return tmpdir
+
+def bench_summary_check_consistency(n):
+    path = _summary_dir(10*n)
+    return lambda: sp.check_consistency(path)
+
+def bench_summary_produce_patch(n):
+    path, patch = _summary_dir(10*n), summary_patch(10*n, n)
+    args = {'translator': {'backend': 'dummy'}}
+    return lambda: sp.produce_target_summary_patch(path=path, target_lang='zh', patch=patch, args=args)
+
+BENCHMARKS = {name[len('bench_'):]: func for name, func in globals().items() if name.startswith('bench_')}
+
+## ================================================================================
+## Runner
+## ================================================================================
+def timeit(func, repeat=3, min_time=0.05):
+    """Best time of 'repeat' rounds. A round repeats the call until it takes at least 'min_time'"""
+    best = math.inf
+    for _ in range(repeat):
+        n_call, start = 0, time.perf_counter()
+        while True:
+            func()
+            n_call += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / n_call)
+    return best
+
+def scaling_exponent(sizes, times):
+    """Slope of log(time) vs log(size) between the two largest sizes. ~1 is linear, ~2 is quadratic"""
+    if len(sizes) < 2 or times[-2] <= 0:
+        return None
+    return math.log(times[-1] / times[-2]) / math.log(sizes[-1] / sizes[-2])
+
+def git_commit():
+    try:
+        return subprocess.check_output('git rev-parse HEAD', shell=True, cwd=ROOT, universal_newlines=True).strip()
+    except subprocess.CalledProcessError:
+        return 'unknown'
+
+def load_baseline(commit):
+    """The last recorded run from a different commit"""
+    if not os.path.exists(HISTORY):
+        return None
+    baseline = None
+    with open(HISTORY) as f:
+        for line in f:
+            run = json.loads(line)
+            if run['commit'] != commit:
+                baseline = run
+    return baseline
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the translator and SummaryParser hot paths')
+    parser.add_argument('-k', default='', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 200, 400])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-save', action='store_true', help='do not append the results to the history')
+    opts = parser.parse_args()
+    _logger.setLevel(logging.WARNING)
+
+    commit = git_commit()
+    baseline = load_baseline(commit)
+    results = {}
+    print(f"{'benchmark':<32}" + ''.join(f'{"n="+str(n):>12}' for n in opts.sizes) + f"{'exponent':>10}{'vs base':>10}")
+    for name, bench in BENCHMARKS.items():
+        if opts.k not in name:
+            continue
+        times = [timeit(bench(n), repeat=opts.repeat) for n in opts.sizes]
+        results[name] = {str(n): t for n, t in zip(opts.sizes, times)}
+        expo = scaling_exponent(opts.sizes, times)
+        ratio = ''
+        if baseline is not None and name in baseline['results'] and str(opts.sizes[-1]) in baseline['results'][name]:
+            ratio = f"{times[-1] / baseline['results'][name][str(opts.sizes[-1])]:.2f}x"
+        print(f'{name:<32}' + ''.join(f'{t*1e3:>10.2f}ms' for t in times) + f"{expo if expo is None else round(expo, 2)!s:>10}{ratio:>10}")
+    if baseline is not None:
+        print(f"\nBaseline: commit {baseline['commit'][:8]} ({time.strftime('%Y-%m-%d %H:%M', time.localtime(baseline['time']))})")
+
+    if not opts.no_save:
+        os.makedirs(os.path.dirname(HISTORY), exist_ok=True)
+        with open(HISTORY, 'a') as fw:
+            fw.write(json.dumps({'commit': commit, 'time': time.time(), 'sizes': opts.sizes, 'results': results}) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,17 @@
 import subprocess
+import asyncio, contextlib
 import yaml
-import os, shutil, time
+import os, shutil, time, json
 from logger import _logger
 from gitutils import get_commit_list, get_diff_tree, get_patch, check_clean, get_commit_author, get_file_last_commit_author
-from gitutils import git_clone, git_pull, git_push
-from translator import DeepLTranslator as Translator
+from gitutils import git_clone, git_pull, git_push, get_commit_time, git_blob_hash
+from translator import make_translator
 from translator import fix_broken_mkdown
 from mail import send_mail
 from summaryparser import SummaryParser as sp
 from externalprocess import ExternalProcess
+from ratelimit import TranslationUnavailable, health_stats
+from searchindex import SearchIndex, SearchServer, index_file
 
 def runcmd(cmd):
     """Run a shell command"""
@@ -18,11 +21,41 @@ def runcmd(cmd):
     out, _ = p.communicate()
     return (out, p.returncode)
 
+async def arun(cmd):
+    """Run a shell command without blocking the event loop"""
+    p = await asyncio.create_subprocess_shell(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    try:
+        out, _ = await p.communicate()
+    except asyncio.CancelledError:
+        p.kill()
+        raise
+    return (out.decode(errors='replace'), p.returncode)
+
+async def in_thread(func, *args):
+    """Like asyncio.to_thread, but a cancellation waits for the thread to finish before it propagates,
+    so that the translator, the scheduler slot or the files it uses are not released while still in use
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await settle([task])
+        raise
+
+async def settle(tasks):
+    """Wait until all the tasks are done, even if cancelled meanwhile"""
+    while not all(task.done() for task in tasks):
+        try:
+            await asyncio.wait([asyncio.shield(task) for task in tasks])
+        except asyncio.CancelledError:
+            pass
+
 class Builder(ExternalProcess):
     """Maintain the main gitbook service"""
 
     def __init__(self, args):
-        super(Builder, self).__init__(args=args, name='builder')
+        name = 'builder' if 'name' not in args else f"builder-{args['name']}"
+        super(Builder, self).__init__(args=args, name=name)
 
     def keep(self):
         """Maintain the main gitbook service"""
@@ -40,9 +73,12 @@ class Builder(ExternalProcess):
                 _logger.error(f'Gitbook init failed. Path: {path}. Output:\n{out}')
                 raise RuntimeError()
         
+        ## Each gitbook server needs its own livereload port. lrport: false disables livereload
+        lrport = args['workarea'].get('lrport', 35729)
+        live_opt = '--no-live' if lrport is False else f'--lrport {lrport}'
         with open(f'{self.name}.out', 'w') as fout:
             p = subprocess.Popen(
-                f'cd {path} && gitbook serve --port 3001', 
+                f"cd {path} && gitbook serve --port {args['workarea'].get('port', 3001)} {live_opt}", 
                 shell=True, universal_newlines=True, stderr=fout, stdout=fout
             ) 
             p.wait()
@@ -52,311 +88,695 @@ class Builder(ExternalProcess):
             self.errormsg.value = '\n'.join(f.readlines()[-50:]) # takes the last 50 rows
         
 
+def dual(path):
+    """The dual file of a zh-hans/ or en/ file, and the translation direction towards it"""
+    if 'zh-hans/' in path:
+        return {'name':path.replace('zh-hans/', 'en/'), 'trans':('zh','en')}
+    elif 'en/' in path:
+        return {'name':path.replace('en/', 'zh-hans/'), 'trans':('en','zh')}
+    else:
+        raise SyntaxError('Wrong path')
+
 class TestMonitor(ExternalProcess):
-    """An external process that do the test monitoring job. Takes most of a bot's job"""
+    """An external process that do the test monitoring job. Takes most of a bot's job.
+    Each cycle runs as an asyncio pipeline, see TestMonitor.cycle for the dependency edges
+    """
 
-    def __init__(self, args):
-        super(TestMonitor, self).__init__(args=args, name='test_monitor')
+    def __init__(self, args, scheduler=None):
+        name = 'test_monitor' if 'name' not in args else f"test_monitor-{args['name']}"
+        super(TestMonitor, self).__init__(args=args, name=name)
+        self.path = args['testarea']['relpath']
+        self.state_dir = args['bot'].get('state_dir', '.')
+        self.scheduler = scheduler # a FairScheduler shared with other repositories, if any
+        self.timings = {}
 
     def keep(self):
         """Git pull the lastest commits, launch local test, do translation when necessary, then provide feedbacks"""
         ## Run super: record pid
         super(TestMonitor, self).keep()
+        try:
+            asyncio.run(self.run())
+        finally: # atexit handlers do not run in a launched process
+            self.close_translators()
+
+    async def run(self):
+        await self.setup()
+        ## Start test monitoring. A webhook may wake the monitor up before the poll interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.args['bot'].get('poll_interval', 10))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.poll()
+
+    ## ================================================================================
+    ## Helpers
+    ## ================================================================================
+    def make_translator(self):
+        return make_translator(self.args, do_post=True, support_mkdown=True)
+
+    def state_file(self, name):
+        """Path of a state file (e.g. .commit_success), kept apart for each repository"""
+        return os.path.join(self.state_dir, name)
+
+    def slot(self, resource):
+        """Hold a 'translate' or 'build' slot of the shared scheduler, if any"""
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(resource, self.args.get('name', self.name))
+
+    def gitlab_link(self, *parts):
+        """Web link on gitlab, e.g. gitlab_link('commit', cid)"""
+        return os.path.join(self.args['gitlab']['home'], self.args['testarea']['git_remote'].split(':')[-1][:-4], '-', *parts)
+
+    @contextlib.contextmanager
+    def stage(self, name, timings=None):
+        """Record the wall time of a stage of the current cycle"""
+        timings = self.timings if timings is None else timings
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = time.perf_counter() - start
 
-        def gitbook_built_success(path):
-            """Build gitbook and check if success"""
-            if not os.path.exists(os.path.join(path, 'node_modules')):
-                _logger.info('Initiating Gitbook...')
-                out, ret = runcmd(f'cd {path} && gitbook init && gitbook install')
-                if ret != 0:
-                    _logger.error(f'Gitbook init failed. Path: {path}. Output:\n{out}')
-                    raise RuntimeError()
-            out, ret = runcmd(f'cd {path} && gitbook build')
+    async def timed(self, name, coro, timings):
+        with self.stage(name, timings):
+            return await coro
+
+    def in_background(self, coro, name=''):
+        """Run a job off the critical path. Errors are logged instead of propagated"""
+        def done(task):
+            self.background.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                _logger.error(f"Background job '{name}' failed. Error: {task.exception()}")
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(done)
+        return task
+
+    async def drain(self):
+        """Wait for all background jobs to finish"""
+        while self.background:
+            await asyncio.gather(*list(self.background), return_exceptions=True)
+
+    def send_mail_bg(self, **kwargs):
+        self.in_background(asyncio.to_thread(send_mail, args=self.args, **kwargs), name='send_mail')
+
+    def notify_error(self, text):
+        _logger.error(text)
+        self.send_mail_bg(subject=self.args['bot']['commit_prefix']+'Wikibot detect error: '+text, text=text)
+
+    def update_workarea(self, cid=None, timings=None):
+        """Pull the workarea in background. Updates are chained so that they never overlap"""
+        prev = self.workarea_task
+        async def update():
+            if prev is not None:
+                await asyncio.gather(prev, return_exceptions=True)
+            workarea = self.args['workarea']['relpath']
+            with self.stage('workarea', timings if timings is not None else {}):
+                if not os.path.exists(workarea) or (await asyncio.to_thread(get_commit_list, path=workarea, n_show=1)) != [self.last_success_cid]:
+                    await asyncio.to_thread(git_pull, path=workarea, args=self.args)
+            if cid is not None and timings is not None:
+                await asyncio.to_thread(self.log_latency, cid, timings)
+        self.workarea_task = self.in_background(update(), name='update_workarea')
+        return self.workarea_task
+
+    def update_search_index(self, cid):
+        """Bring the search index to 'cid' in background, re-indexing the changed files only. Updates are chained"""
+        if 'search' not in self.args:
+            return None
+        prev = self.search_task
+        async def update():
+            if prev is not None:
+                await asyncio.gather(prev, return_exceptions=True)
+            if self.search_index is None: # loaded on first use
+                self.search_index = await asyncio.to_thread(SearchIndex, index_file(self.args))
+            start = time.perf_counter()
+            n_files = await asyncio.to_thread(self.search_index.update, self.path, cid)
+            _logger.info(f'Search index updated to {cid[:8]}: {n_files} file(s) in {time.perf_counter()-start:.2f} s')
+        self.search_task = self.in_background(update(), name='update_search_index')
+        return self.search_task
+
+    def log_latency(self, cid, timings):
+        commit_time = get_commit_time(path=self.path, commit_id=cid)
+        timings['published'] = time.time()
+        stages = ', '.join(f'{k}: {v:.2f} s' for k, v in timings.items() if k not in ('detected', 'published'))
+        _logger.info(f"Commit {cid[:8]} published. Commit-to-published latency: {timings['published']-commit_time:.1f} s "
+                     f"(detected-to-published: {timings['published']-timings['detected']:.1f} s). Stages: {stages}")
+
+    async def build(self):
+        """Build gitbook and check if success"""
+        path = self.path
+        init_cmd = self.args['testarea'].get('init_cmd', 'gitbook init && gitbook install')
+        build_cmd = self.args['testarea'].get('build_cmd', 'gitbook build')
+        if init_cmd and not os.path.exists(os.path.join(path, 'node_modules')):
+            _logger.info('Initiating Gitbook...')
+            async with self.slot('build'):
+                out, ret = await arun(f'cd {path} && {init_cmd}')
             if ret != 0:
-                _logger.error(f'Gitbook build failed. Path: {path}. Output:\n{out}')
-                return (False, out)
-            return (True, None)
-
-        def dual(path):
-            if 'zh-hans/' in path:
-                return {'name':path.replace('zh-hans/', 'en/'), 'trans':('zh','en')}
-            elif 'en/' in path:
-                return {'name':path.replace('en/', 'zh-hans/'), 'trans':('en','zh')}
-            else:
-                raise SyntaxError('Wrong path')
-
-        def notify_error(text):
-            _logger.error(text)
-            send_mail(subject=args['bot']['commit_prefix']+'Wikibot detect error: '+text, text=text, args=args)
-        
-        def translate_from_to(_translator, lang, from_path, to_path):
-            with open(from_path) as f:
-                text = f.read()
-            text = _translator.launch(text, target_lang=lang[1], source_lang=lang[0])
-            with open(to_path, 'w') as fw:
-                fw.write(text)
-
-        ## Set up testarea if not exists / update the testarea to sync the remote
-        args = self.args
-        path = args['testarea']['relpath']
-        if not os.path.exists(args['testarea']['relpath']):
-            _logger.debug(f"Git clone to {args['testarea']['relpath']}")
-            git_clone(git_remote=args['testarea']['git_remote'], setup_dir=path, args=args)
+                _logger.error(f'Gitbook init failed. Path: {path}. Output:\n{out}')
+                raise RuntimeError()
+        async with self.slot('build'):
+            out, ret = await arun(f'cd {path} && {build_cmd}')
+        if ret != 0:
+            _logger.error(f'Gitbook build failed. Path: {path}. Output:\n{out}')
+            return (False, out)
+        return (True, None)
+
+    def write_commit_success(self):
+        with open(self.state_file('.commit_success'), 'w') as fw:
+            fw.write(self.last_success_cid)
+
+    def load_warm_state(self):
+        if not os.path.exists(self.state_file('.warm_state.json')):
+            return {}
+        with open(self.state_file('.warm_state.json')) as f:
+            return json.load(f)
+
+    def save_warm_state(self, cid):
+        """Record the commit that was last built and validated in the testarea, so that a restart can skip the build"""
+        with open(self.state_file('.warm_state.json'), 'w') as fw:
+            json.dump({'validated_cid': cid, 'time': time.time()}, fw)
+
+    def is_warm(self):
+        """Whether the testarea still holds the tree and the build artifacts of the last validated commit"""
+        build_dir = self.args['testarea'].get('build_dir', '_book')
+        return (
+            self.load_warm_state().get('validated_cid') == self.last_cid
+            and check_clean(path=self.path)
+            and (not build_dir or os.path.exists(os.path.join(self.path, build_dir)))
+        )
+
+    def warm_up(self):
+        """Heavy imports and browser launches of the translators, run in background at startup"""
+        for _translator in self.translator_list:
+            _translator.warm_up()
+
+    def close_translators(self):
+        """Quit the prelaunched browsers. The pool exists once the monitor is set up"""
+        for _translator in getattr(self, 'translator_list', []):
+            _translator.close()
+
+    ## ================================================================================
+    ## Translation and the retry queue
+    ## ================================================================================
+    def translate_file(self, _translator, lang, from_path):
+        """Translate a file. Returns None if the backend is unavailable"""
+        with open(from_path) as f:
+            text = f.read()
+        try:
+            return _translator.launch(text, target_lang=lang[1], source_lang=lang[0])
+        except TranslationUnavailable as e:
+            _logger.warning(f'Translation of {from_path} is unavailable. Error: {e}')
+            return None
+
+    async def translate_all(self, jobs):
+        """Run the translation jobs [(lang, from_path, to_path), ...] concurrently on the translator pool"""
+        async def run(job):
+            async with self.slot('translate'):
+                _translator = await self.translators.get()
+                try:
+                    return await in_thread(self.translate_file, _translator, job[0], job[1])
+                finally:
+                    self.translators.put_nowait(_translator)
+        tasks = [asyncio.ensure_future(run(job)) for job in jobs]
+        try:
+            return await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            ## Jobs waiting for a translator stop at once, running ones keep their translator until the thread is done
+            for task in tasks:
+                task.cancel()
+            await settle(tasks)
+            raise
+
+    def load_trans_queue(self):
+        if not os.path.exists(self.state_file('.trans_queue.json')):
+            return []
+        with open(self.state_file('.trans_queue.json')) as f:
+            return json.load(f)
+
+    def save_trans_queue(self, jobs):
+        with open(self.state_file('.trans_queue.json'), 'w') as fw:
+            json.dump(jobs, fw, indent=1)
+
+    def queue_trans_job(self, lang, from_path, to_path):
+        jobs = [job for job in self.load_trans_queue() if job['to_path'] != to_path]
+        jobs.append({'lang': list(lang), 'from_path': from_path, 'to_path': to_path, 'queued_at': time.time()})
+        self.save_trans_queue(jobs)
+
+    def dequeue_trans_job(self, to_path, reason=None):
+        """Drop the queued job of a dual file, if any. The reason is logged, unless the job is done otherwise"""
+        jobs = self.load_trans_queue()
+        if any(job['to_path'] == to_path for job in jobs):
+            if reason is not None:
+                _logger.warning(f'Queued translation of {os.path.relpath(to_path, self.path)} is dropped: {reason}')
+            self.save_trans_queue([job for job in jobs if job['to_path'] != to_path])
+
+    def requeue_trans_job(self, to_path, from_path_new, to_path_new, keep=False):
+        """Point the queued job of a dual file to a moved (keep=False) or copied (keep=True) source"""
+        jobs = self.load_trans_queue()
+        moved = [dict(job, from_path=from_path_new, to_path=to_path_new) for job in jobs if job['to_path'] == to_path]
+        if len(moved) > 0:
+            _logger.info(f'Queued translation of {os.path.relpath(to_path, self.path)} now goes to {os.path.relpath(to_path_new, self.path)}')
+            jobs = [job for job in jobs if job['to_path'] != to_path_new and (keep or job['to_path'] != to_path)]
+            self.save_trans_queue(jobs + moved)
+
+    def load_translated_hashes(self):
+        """The git blob hash of each source file when it was last auto-translated, e.g. {'en/a.md': 'e69de29...'}"""
+        if not os.path.exists(self.state_file('.translated_hashes.json')):
+            return {}
+        with open(self.state_file('.translated_hashes.json')) as f:
+            return json.load(f)
+
+    def record_translated(self, from_paths):
+        hashes = self.load_translated_hashes()
+        for from_path in from_paths:
+            with open(from_path, 'rb') as f:
+                hashes[os.path.relpath(from_path, self.path)] = git_blob_hash(f.read())
+        with open(self.state_file('.translated_hashes.json'), 'w') as fw:
+            json.dump(hashes, fw, indent=1)
+
+    def dump_health_stats(self):
+        with open(self.state_file('.translator_health.json'), 'w') as fw:
+            json.dump(health_stats(), fw, indent=1)
+
+    async def retry_trans_queue(self):
+        """Retry the queued translation jobs if the backend is back, and push the results"""
+        args, path = self.args, self.path
+        jobs = self.load_trans_queue()
+        if len(jobs) == 0 or not self.translator_list[0].available():
+            return
+        def still_wanted(job):
+            if not os.path.exists(job['from_path']): # source removed in the meantime
+                _logger.warning(f"Queued translation of {os.path.relpath(job['to_path'], path)} is dropped: its source is removed")
+                return False
+            fpath_dual = os.path.relpath(job['to_path'], path)
+            if os.path.exists(job['to_path']) and get_file_last_commit_author(path=path, fpath=fpath_dual)[0] != args['bot']['author']:
+                _logger.info(f'Queued translation of {fpath_dual} is dropped: the file is now maintained by human')
+                return False
+            return True
+        todo = await asyncio.to_thread(lambda: [job for job in jobs if still_wanted(job)])
+        texts = await self.translate_all([(job['lang'], job['from_path'], job['to_path']) for job in todo])
+        retried = []
+        for job, text in zip(todo, texts):
+            if text is not None:
+                with open(job['to_path'], 'w') as fw:
+                    fw.write(text)
+                self.record_translated([job['from_path']])
+                retried.append(os.path.relpath(job['to_path'], path))
+        self.save_trans_queue([job for job, text in zip(todo, texts) if text is None])
+        self.dump_health_stats()
+        if len(retried) > 0 and not (await asyncio.to_thread(check_clean, path=path)):
+            if not (await self.build())[0]:
+                self.notify_error('Cannot built successful after retrying the queued translations... Will stop here')
+                raise RuntimeError()
+            await asyncio.to_thread(git_push, path=path, msg=args['bot']['commit_prefix']+'Auto-translation for queued files', args=args)
+            self.last_cid = self.last_success_cid = (await asyncio.to_thread(get_commit_list, path=path, n_show=1))[0]
+            self.write_commit_success()
+            _logger.info('Queued files are auto-translated:\n{}'.format('\n'.join(retried)))
+            self.update_workarea()
+
+    ## ================================================================================
+    ## The monitoring cycle
+    ## ================================================================================
+    def init_translators(self):
+        """Init the translator pool. All instances share the backend guard (see ratelimit.py)"""
+        self.translator_list = [self.make_translator() for _ in range(self.args.get('translator', {}).get('concurrency', 2))]
+        self.translators = asyncio.Queue()
+        for _translator in self.translator_list:
+            self.translators.put_nowait(_translator)
+
+    async def setup(self):
+        """Set up testarea if not exists / update the testarea to sync the remote"""
+        args, path = self.args, self.path
+        self.background = set()
+        self.workarea_task = None
+        self.search_task, self.search_index = None, None
+        self.wakeup = asyncio.Event()
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.init_translators()
+        self.in_background(asyncio.to_thread(self.warm_up), name='warm_up')
+
+        if not os.path.exists(path):
+            _logger.debug(f"Git clone to {path}")
+            await asyncio.to_thread(git_clone, git_remote=args['testarea']['git_remote'], setup_dir=path, args=args)
         else:
-            git_pull(path=path, args=args)
-        last_cid = get_commit_list(path=path, n_show=1)[0]
+            await asyncio.to_thread(git_pull, path=path, args=args)
+        self.last_cid = (await asyncio.to_thread(get_commit_list, path=path, n_show=1))[0]
 
-        ## Assert that current repo can be built successfully, and SUMMARY.md has consistent format
-        if gitbook_built_success(path)[0] and sp.check_consistency(path):
-            last_success_cid = last_cid
+        ## Assert that current repo can be built successfully, and SUMMARY.md has consistent format.
+        ## Skipped if the head is still the commit validated before the restart
+        if await asyncio.to_thread(self.is_warm):
+            _logger.info(f'Warm start: {self.last_cid[:8]} is built and validated already')
+            self.last_success_cid = self.last_cid
+            self.update_workarea()
+        elif (await self.build())[0] and (await asyncio.to_thread(sp.check_consistency, path)):
+            self.last_success_cid = self.last_cid
+            self.save_warm_state(self.last_cid)
             ## Also pull the lastest repo to workarea
-            git_pull(path=args['workarea']['relpath'], args=args)
+            self.update_workarea()
         else:
             _logger.warning('Problem detected with current remote repo! It is either a build failure, or inconsistency in SUMMARY.md. We will read the last success commit id')
-            with open('.commit_success') as f:
-                last_success_cid = f.read().split('\n')[0]
-        _logger.debug(f'last_success_cid while enter: {last_success_cid}')
-            
-        with open('.commit_success', 'w') as fw:
-            fw.write(last_success_cid)
+            with open(self.state_file('.commit_success')) as f:
+                self.last_success_cid = f.read().split('\n')[0]
+        _logger.debug(f'last_success_cid while enter: {self.last_success_cid}')
+        self.write_commit_success()
+        self.update_search_index(self.last_success_cid)
 
-        ## Init translator
-        trans = Translator(selenium_configs={'http_proxy':'127.0.0.1:8090', 'headless':True}, do_post=True, support_mkdown=True)
+    async def poll(self):
+        """Check the remote once. Handle the new commits if any, otherwise retry the queued translations"""
+        remote_last_cid = (await asyncio.to_thread(get_commit_list, path=self.path, n_show=1, remote=True))[0]
+        if self.last_cid == remote_last_cid: # nothing changed
+            await self.retry_trans_queue()
+            return
+        await self.cycle(remote_last_cid)
 
-        ## Start test monitoring
-        while True:
-            time.sleep(10)
-            remote_last_cid = get_commit_list(path=path, n_show=1, remote=True)[0]
-            if last_cid == remote_last_cid: # nothing changed. Go to next iteration
-                continue
-            
-            ## New remote changes detected. First do git pull
-            git_pull(path=path, args=args)
-            
-            ## Get all untracked cid by looking back to the commit list (not used now. we treat all untracked cid as a whole)
-            untracked_cid = []
-            for cid in get_commit_list(path=path, n_show=20):
-                untracked_cid.append(cid)
-                if cid == last_cid:
-                    break
-            _logger.info(f"New commits pulled to local: {', '.join(untracked_cid[:-1][::-1])}")
-
-            ## Update last commit id, get the author
-            last_cid = remote_last_cid
-            commit_author = get_commit_author(path=path, commit_id=remote_last_cid)
-            
-            ## First check if can successfully built
-            gb_success, gb_out = gitbook_built_success(path)
+    async def cycle(self, remote_last_cid):
+        """Handle the new remote commits. The stages overlap along these dependency edges:
+            pull -> pre-build ----------------------+
+            pull -> plan (+SUMMARY.md) -> translate -+-> apply -> rebuild -> push -> mail (background)
+                                                                                 -> workarea update (background)
+        If the pre-build fails, the plan and translations are cancelled
+        """
+        args, path = self.args, self.path
+        self.timings = timings = {'detected': time.time()}
+
+        ## New remote changes detected. First do git pull
+        with self.stage('pull'):
+            await asyncio.to_thread(git_pull, path=path, args=args)
+
+        ## Get all untracked cid by looking back to the commit list (not used now. we treat all untracked cid as a whole)
+        untracked_cid = []
+        for cid in await asyncio.to_thread(get_commit_list, path=path, n_show=20):
+            untracked_cid.append(cid)
+            if cid == self.last_cid:
+                break
+        _logger.info(f"New commits pulled to local: {', '.join(untracked_cid[:-1][::-1])}")
+
+        ## Update last commit id, get the author
+        self.last_cid = remote_last_cid
+        commit_author = await asyncio.to_thread(get_commit_author, path=path, commit_id=remote_last_cid)
+        last_success_cid = self.last_success_cid
+
+        ## Pre-build, and meanwhile work out the plan and run the translations. Nothing is written to the testarea yet
+        async def plan_and_translate():
+            diff_tree = await asyncio.to_thread(get_diff_tree, path=path, commit_id=f'{last_success_cid}..{remote_last_cid}')
+            plan = await in_thread(self.plan, diff_tree, last_success_cid, remote_last_cid)
+            plan['texts'] = await self.translate_all(plan['jobs'])
+            return plan
+        build_task = asyncio.create_task(self.timed('pre-build', self.build(), timings))
+        trans_task = asyncio.create_task(self.timed('translate', plan_and_translate(), timings))
+        try:
+            gb_success, gb_out = await build_task
             if not gb_success:
+                trans_task.cancel()
                 mail_templ = 'Dear {author},\n\nThe commit {cid}\nis successfully pushed to origin/master.\n'
                 mail_templ += 'However it cannot be built successfully. See the log below:\n\n{gb_out}\n\nCheers,\nBot\n'
-                send_mail(
+                self.send_mail_bg(
                     subject=args['bot']['commit_prefix']+'Commit {cid8} merged to hepwiki. Problem detected'.format(cid8=remote_last_cid[:8]),
                     text=mail_templ.format(
                         author=commit_author[0],
-                        cid=os.path.join(args['gitlab']['home'], args['testarea']['git_remote'].split(':')[-1][:-4], '-/commit', remote_last_cid),
+                        cid=self.gitlab_link('commit', remote_last_cid),
                         gb_out=gb_out,
                     ),
-                    args=args, receiver='{} <{}>'.format(*commit_author), bcc_admin=True,
+                    receiver='{} <{}>'.format(*commit_author), bcc_admin=True,
                 )
-            else: # success! Do bot's job
-                ## Get the diff tree list
-                diff_tree = get_diff_tree(path=path, commit_id=f'{last_success_cid}..{remote_last_cid}')
-                _logger.info('Tree diff: \n{df}'.format(df='\n'.join(['\t'.join(line) for line in diff_tree])))
-                
-                ## Get list of modified files and moved files
-                modif_files, modif_sum_files, moved_files = [], [], []
-                auto_trans, need_manual_trans = [], []
-                for line in diff_tree:
-                    if (line[-1].startswith('zh-hans/') or line[-1].startswith('en/')) and line[-1].endswith('.md'):
-                        if line[-1].endswith('/SUMMARY.md'):
-                            modif_sum_files.append(line[-1]) ## specially record the changed summary file
-                        else:
-                            modif_files.append(line[-1])
-                        if len(line)==3:
-                            moved_files.append(line[1])
-                _logger.info(f"modif_files:       [{', '.join(modif_files)}]")
-                _logger.info(f"modif_files (sum): [{', '.join(modif_sum_files)}]")
-                _logger.info(f"moved_files:       [{', '.join(moved_files)}]")
-
-                ## ================================================================================
-                ## 1. First handles the SUMMARY.md file
-                ## ================================================================================
-                is_modif_sum_lang = ['zh-hans/SUMMARY.md' in modif_sum_files, 'en/SUMMARY.md' in modif_sum_files]
-                if sum(is_modif_sum_lang) == 2: # modified both
-                    # Check if consistent
-                    if not sp.check_consistency(path=path):
-                        mail_templ = 'Dear {author},\n\nThe commit {cid}\nis successfully pushed to origin/master.\n'
-                        mail_templ += 'It seems you have modified both SUMMARY.md in zh-hans/ and en/, while they are not consistent after revision.'
-                        mail_templ += 'Please check the syntax of two SUMMARY.md files below (especially check the spacing) and make another commit:\n\n{weblink}\n\nCheers,\nBot\n'
-                        send_mail(
-                            subject=args['bot']['commit_prefix']+'Commit {cid8} merged to hepwiki. Problem detected'.format(cid8=remote_last_cid[:8]),
-                            text=mail_templ.format(
-                                author=commit_author[0],
-                                cid=os.path.join(args['gitlab']['home'], args['testarea']['git_remote'].split(':')[-1][:-4], '-/commit', remote_last_cid),
-                                weblink='\n'.join([
-                                    os.path.join(args['gitlab']['home'], args['testarea']['git_remote'].split(':')[-1][:-4], '-/raw', remote_last_cid, 'zh-hans/SUMMARY.md'),
-                                    os.path.join(args['gitlab']['home'], args['testarea']['git_remote'].split(':')[-1][:-4], '-/raw', remote_last_cid, 'en/SUMMARY.md'),
-                                ]),
-                            ),
-                            args=args, receiver='{} <{}>'.format(*commit_author), bcc_admin=True,
-                        )
-                        continue # directly go to next iteration and wait for future fix
-                elif sum(is_modif_sum_lang) == 1:
-                    fpath = 'zh-hans/SUMMARY.md' if is_modif_sum_lang[0] else 'en/SUMMARY.md'
-                    ## Obtain the target patch that modifies the dual file
-                    patch_text_dual = sp.produce_target_summary_patch(
-                        path=path, 
-                        target_lang='en' if is_modif_sum_lang[0] else 'zh', # target lang is the dual of modified lang
-                        patch=get_patch(path=path, commit_id=f'{last_success_cid}..{remote_last_cid}', ext_cmd=f'-U0 -- {fpath}')
-                    )
-                    with open('.tmp.patch', 'w') as fw:
-                        fw.write(patch_text_dual)
-                    ## Modify the dual file
-                    out, ret = runcmd('patch --dry-run {fp} .tmp.patch'.format(fp=os.path.join(path, dual(fpath)['name'])))
-                    if ret != 0: # dry-run fails. This should not happen
-                        notify_error(f"In commit {remote_last_cid}: Bot failed to modify the dual SUMMARY.md file. Please fix this manually")
-                        need_manual_trans.append(dual(fpath)['name'])
-                    else: # patch the dual file
-                        runcmd('patch {fp} .tmp.patch'.format(fp=os.path.join(path, dual(fpath)['name'])))
-                        auto_trans.append(dual(fpath)['name'])
-                    
-                elif sum(is_modif_sum_lang) == 0:
-                    if not sp.check_consistency(path=path): # this should never happen
-                        notify_error(f"In commit {remote_last_cid}: nothing changed to lang/SUMMARY.md but inconsistency detected.")
-
-
-                ## ================================================================================
-                ## 2. Then check line by line and handles all detected file changes
-                ## ================================================================================
-                for line in diff_tree:
-                    if not (line[1].startswith('zh-hans/') or line[1].startswith('en/')): # files not related to lingual
-                        continue
-                    if not (line[-1].startswith('zh-hans/') or line[-1].startswith('en/')): # files not related to lingual
-                        continue
-                    if line[-1].endswith('/SUMMARY.md'): # they are handled already
-                        continue
-                    fpath = line[-1]
-                    absfpath = os.path.join(path, fpath)
-                    absfpath_dual = os.path.join(path, dual(fpath)['name'])
-                    if not os.path.exists(os.path.dirname(absfpath_dual)): # make dual folder if not exists
-                        os.makedirs(os.path.dirname(absfpath_dual))    
-
-                    if line[0] == 'D': # case: a file is deleted
-                        if fpath not in moved_files: # not moved away
-                            _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} will be removed")
-                            os.remove(absfpath_dual)
-                    if line[0] == 'A': # case: a new file is added. We create the dual file.
-                        if os.path.exists(absfpath_dual):
-                            notify_error(f"In commit {remote_last_cid}: {dual(fpath)['name']} should not exist, since {fpath} is just created")
-                        if fpath.endswith('.md'): # need translation
-                            if not os.path.exists(dual(fpath)['name']) or (os.path.exists(dual(fpath)['name']) and get_file_last_commit_author(path=path, fpath=dual(fpath)['name'])[0] == args['bot']['author']):
-                                _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} is auto-translated")
-                                translate_from_to(
-                                    trans,
-                                    lang=dual(fpath)['trans'],
-                                    from_path=absfpath,
-                                    to_path=absfpath_dual,
-                                )
-                                auto_trans.append(dual(fpath)['name'])
-                            else:
-                                need_manual_trans.append(dual(fpath)['name'])
-                        else: # direct copy is fine
-                            shutil.copy(absfpath, absfpath_dual)
+                return
+            plan = await trans_task
+        finally:
+            for task in (build_task, trans_task):
+                if not task.done():
+                    task.cancel()
+            ## Running plan and translation threads keep their translators and slots until they finish
+            await settle([build_task, trans_task])
 
-                    elif line[0] == 'M': # case: modify a file. We check if corresponding file was previous modified. Do translation if not.
-                        if fpath.endswith('.md'): # need translation
-                            if os.path.exists(absfpath_dual):
-                                if fpath not in moved_files: # not moved away. Means that this is a "real" modification
-                                    if dual(fpath)['name'] not in modif_files: # dual file not modified in the same commit
-                                        # and its last revision is made by bot => can do auto-translate
-                                        if get_file_last_commit_author(path=path, fpath=dual(fpath)['name'])[0] == args['bot']['author']:
-                                            _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} is auto-translated")
-                                            translate_from_to(
-                                                trans,
-                                                lang=dual(fpath)['trans'], 
-                                                from_path=absfpath,
-                                                to_path=absfpath_dual,
-                                            )
-                                            auto_trans.append(dual(fpath)['name'])
-                                        else:
-                                            need_manual_trans.append(dual(fpath)['name'])
-                            else:
-                                notify_error(f"In commit {remote_last_cid}: {dual(fpath)['name']} should have existed")
-                        else: # direct copy is fine (may overide)
-                            shutil.copy(absfpath, absfpath_dual)
-
-                    elif line[0].startswith('C') or line[0].startswith('R'):
-                        fpath_orig = line[1]
-                        if os.path.exists(os.path.join(path, dual(fpath_orig)['name'])):
-                            if line[0][1:] == '100': # 100% changed (simply move/copy)
-                                ## Simply move to new dir. The file may be either .md or others
-                                os.system(f"cd {path} && git mv {dual(fpath_orig)['name']} {dual(fpath)['name']} && cd -")
-                            else: ## despite of pure copy/move, also detect revision
-                                if fpath.endswith('.md'): # need translation
-                                    ## Check the latest author of the original dual file (before moving)
-                                    if get_file_last_commit_author(path=path, fpath=dual(fpath_orig)['name'])[0] == args['bot']['author']:
-                                        translate_from_to(
-                                            trans, 
-                                            lang=dual(fpath)['trans'], 
-                                            from_path=absfpath, 
-                                            to_path=absfpath_dual,
-                                        )
-                                        auto_trans.append(dual(fpath)['name']) # append to auto translated list
-                                        os.remove(os.path.join(path, dual(fpath_orig)['name'])) # remove the original
-                                    else:
-                                        need_manual_trans.append(dual(fpath)['name']) # warn users that the file needs manual translation
-                                        os.rename(os.path.join(path, dual(fpath_orig)['name']), absfpath_dual) # simply rename the original file
-                                else: # direct copy is fine
-                                    shutil.copy(absfpath, absfpath_dual)
-                
-                ## Do git push if workspace is not clean (file changed by bot)
-                need_push = not check_clean(path=path)
-                if need_push:
-                    ## Check if can sill build successfully
-                    if not gitbook_built_success(path):
-                        notify_error('Cannot built successful after our bot\'s works... Will stop here')
-                        raise RuntimeError()
-                    git_push(path=path, msg=args['bot']['commit_prefix']+f'Auto-translation for commit {remote_last_cid}', args=args)
-                
-                last_cid = get_commit_list(path=path, n_show=1)[0]
-                last_success_cid = last_cid
-                ## Update successful commit
-                with open('.commit_success', 'w') as fw:
-                    fw.write(last_success_cid)
-                new_diff_tree = get_diff_tree(path=path, commit_id=f'{remote_last_cid}..{last_success_cid}')
+        ## Success! Do bot's job
+        diff_tree = plan['diff_tree']
+        if plan['abort'] is not None: # problem in the commit. Wait for future fix
+            self.send_mail_bg(**plan['abort'], receiver='{} <{}>'.format(*commit_author), bcc_admin=True)
+            return
+        for text in plan['errors']:
+            self.notify_error(text)
+        with self.stage('apply'):
+            auto_trans, queued_trans = await in_thread(self.apply, plan)
+        need_manual_trans = plan['need_manual_trans']
+        self.dump_health_stats()
 
-                mail_templ = 'Dear {author},\n\nThe commit {cid}\nis successfully pushed to origin/master.\n'
-                mail_templ += 'The repo can be successfully built. Listed below are the file changes w.r.t. lastest successful build:\n\n'
-                mail_templ += '\n'.join(['\t'.join(line) for line in diff_tree])+'\n\n'
-                if len(auto_trans) == 0:
-                    mail_templ += 'No files are auto-translated.\n\n'
-                else:
-                    mail_templ += '📙 The following file(s) are auto-translated:\n\n{auto_trans_text}\n\n'
-                if len(need_manual_trans) == 0:
-                    mail_templ += 'No files need manual translation.\n\n'
+        ## Do git push if workspace is not clean (file changed by bot)
+        need_push = not (await asyncio.to_thread(check_clean, path=path))
+        if need_push:
+            ## Check if can sill build successfully
+            with self.stage('rebuild'):
+                gb_success = (await self.build())[0]
+            if not gb_success:
+                self.notify_error('Cannot built successful after our bot\'s works... Will stop here')
+                await self.drain()
+                raise RuntimeError()
+            with self.stage('push'):
+                await asyncio.to_thread(git_push, path=path, msg=args['bot']['commit_prefix']+f'Auto-translation for commit {remote_last_cid}', args=args)
+
+        self.last_cid = self.last_success_cid = last_success_cid = (await asyncio.to_thread(get_commit_list, path=path, n_show=1))[0]
+        ## Update successful commit
+        self.write_commit_success()
+        self.save_warm_state(last_success_cid)
+
+        ## Finally, do git pull in workarea (in background). The remote can be sync-ed to workarea now
+        self.update_workarea(cid=remote_last_cid, timings=timings)
+        self.update_search_index(last_success_cid)
+
+        new_diff_tree = await asyncio.to_thread(get_diff_tree, path=path, commit_id=f'{remote_last_cid}..{last_success_cid}')
+        mail_templ = 'Dear {author},\n\nThe commit {cid}\nis successfully pushed to origin/master.\n'
+        mail_templ += 'The repo can be successfully built. Listed below are the file changes w.r.t. lastest successful build:\n\n'
+        mail_templ += '\n'.join(['\t'.join(line) for line in diff_tree])+'\n\n'
+        if len(auto_trans) == 0:
+            mail_templ += 'No files are auto-translated.\n\n'
+        else:
+            mail_templ += '📙 The following file(s) are auto-translated:\n\n{auto_trans_text}\n\n'
+        if len(need_manual_trans) == 0:
+            mail_templ += 'No files need manual translation.\n\n'
+        else:
+            mail_templ += '⚠️ The following file(s) may need manual translation:\n\n{need_manual_trans_text}\n\n'
+        if len(queued_trans) > 0:
+            mail_templ += '⏳ The translation service is unavailable now. The following file(s) are queued and will be auto-translated later:\n\n{queued_trans_text}\n\n'
+        if need_push:
+            mail_templ += 'I have made another submit dealing with the translation. The latest commit is at:\n{bot_cid}\n\n'
+            mail_templ += 'Listed below is the file changes w.r.t. your commit:\n\n'
+            mail_templ += '\n'.join(['\t'.join(line) for line in new_diff_tree])+'\n\n'
+
+        mail_templ += 'Cheers,\nBot\n'
+        self.send_mail_bg(
+            subject=args['bot']['commit_prefix']+'Commit {cid8} merged to hepwiki. Built successfully'.format(cid8=remote_last_cid[:8]),
+            text=mail_templ.format(
+                author=commit_author[0],
+                cid=self.gitlab_link('commit', remote_last_cid),
+                auto_trans_text='\n'.join(auto_trans),
+                need_manual_trans_text='\n'.join(need_manual_trans),
+                queued_trans_text='\n'.join(queued_trans),
+                bot_cid=self.gitlab_link('commit', last_success_cid),
+            ),
+            receiver='{} <{}>'.format(*commit_author), bcc_admin=True,
+        )
+
+    def plan(self, diff_tree, last_success_cid, remote_last_cid):
+        """Work out what to do with the dual files, without modifying tracked files. Returns a dict of
+            - ops: the file operations for TestMonitor.apply, in order
+            - jobs: the translation jobs (lang, from_path, to_path) referred to by the 'translate' ops
+            - auto_trans / need_manual_trans: the dual files auto-translated / that need manual translation
+            - errors: problems to notify the admin
+            - abort: the mail to send instead, if the commit cannot be handled
+        A dual file whose translation is still queued (see TestMonitor.queue_trans_job) is owned by the bot, even if not created yet
+        """
+        args, path = self.args, self.path
+        queued = {job['to_path'] for job in self.load_trans_queue()}
+        plan = {'diff_tree': diff_tree, 'ops': [], 'jobs': [], 'auto_trans': [], 'need_manual_trans': [], 'errors': [], 'abort': None}
+        ops, auto_trans, need_manual_trans = plan['ops'], plan['auto_trans'], plan['need_manual_trans']
+        def add_trans_job(fpath, absfpath, absfpath_dual, absfpath_orig=None):
+            plan['jobs'].append((dual(fpath)['trans'], absfpath, absfpath_dual))
+            ops.append(('translate', len(plan['jobs'])-1, dual(fpath)['name'], absfpath_orig))
+
+        _logger.info('Tree diff: \n{df}'.format(df='\n'.join(['\t'.join(line) for line in diff_tree])))
+
+        ## Get list of modified files and moved files
+        modif_files, modif_sum_files, moved_files = [], [], []
+        for line in diff_tree:
+            if (line[-1].startswith('zh-hans/') or line[-1].startswith('en/')) and line[-1].endswith('.md'):
+                if line[-1].endswith('/SUMMARY.md'):
+                    modif_sum_files.append(line[-1]) ## specially record the changed summary file
                 else:
-                    mail_templ += '⚠️ The following file(s) may need manual translation:\n\n{need_manual_trans_text}\n\n'
-                if need_push:
-                    mail_templ += 'I have made another submit dealing with the translation. The latest commit is at:\n{bot_cid}\n\n'
-                    mail_templ += 'Listed below is the file changes w.r.t. your commit:\n\n'
-                    mail_templ += '\n'.join(['\t'.join(line) for line in new_diff_tree])+'\n\n'
-                
-                mail_templ += 'Cheers,\nBot\n'
-                send_mail(
-                    subject=args['bot']['commit_prefix']+'Commit {cid8} merged to hepwiki. Built successfully'.format(cid8=remote_last_cid[:8]),
+                    modif_files.append(line[-1])
+                if len(line)==3:
+                    moved_files.append(line[1])
+        _logger.info(f"modif_files:       [{', '.join(modif_files)}]")
+        _logger.info(f"modif_files (sum): [{', '.join(modif_sum_files)}]")
+        _logger.info(f"moved_files:       [{', '.join(moved_files)}]")
+
+        ## ================================================================================
+        ## 1. First handles the SUMMARY.md file
+        ## ================================================================================
+        is_modif_sum_lang = ['zh-hans/SUMMARY.md' in modif_sum_files, 'en/SUMMARY.md' in modif_sum_files]
+        if sum(is_modif_sum_lang) == 2: # modified both
+            # Check if consistent
+            if not sp.check_consistency(path=path):
+                mail_templ = 'Dear {author},\n\nThe commit {cid}\nis successfully pushed to origin/master.\n'
+                mail_templ += 'It seems you have modified both SUMMARY.md in zh-hans/ and en/, while they are not consistent after revision.'
+                mail_templ += 'Please check the syntax of two SUMMARY.md files below (especially check the spacing) and make another commit:\n\n{weblink}\n\nCheers,\nBot\n'
+                commit_author = get_commit_author(path=path, commit_id=remote_last_cid)
+                plan['abort'] = dict(
+                    subject=args['bot']['commit_prefix']+'Commit {cid8} merged to hepwiki. Problem detected'.format(cid8=remote_last_cid[:8]),
                     text=mail_templ.format(
                         author=commit_author[0],
-                        cid=os.path.join(args['gitlab']['home'], args['testarea']['git_remote'].split(':')[-1][:-4], '-/commit', remote_last_cid),
-                        auto_trans_text='\n'.join(auto_trans),
-                        need_manual_trans_text='\n'.join(need_manual_trans),
-                        bot_cid=os.path.join(args['gitlab']['home'], args['testarea']['git_remote'].split(':')[-1][:-4], '-/commit', last_success_cid),
+                        cid=self.gitlab_link('commit', remote_last_cid),
+                        weblink='\n'.join([
+                            self.gitlab_link('raw', remote_last_cid, 'zh-hans/SUMMARY.md'),
+                            self.gitlab_link('raw', remote_last_cid, 'en/SUMMARY.md'),
+                        ]),
                     ),
-                    args=args, receiver='{} <{}>'.format(*commit_author), bcc_admin=True,
                 )
+                return plan
+        elif sum(is_modif_sum_lang) == 1:
+            fpath = 'zh-hans/SUMMARY.md' if is_modif_sum_lang[0] else 'en/SUMMARY.md'
+            ## Obtain the target patch that modifies the dual file
+            try:
+                patch_text_dual = sp.produce_target_summary_patch(
+                    path=path, 
+                    target_lang='en' if is_modif_sum_lang[0] else 'zh', # target lang is the dual of modified lang
+                    patch=get_patch(path=path, commit_id=f'{last_success_cid}..{remote_last_cid}', ext_cmd=f'-U0 -- {fpath}'),
+                    args=args,
+                )
+                with open(self.state_file('.tmp.patch'), 'w') as fw:
+                    fw.write(patch_text_dual)
+                ## Check the patch on the dual file
+                out, ret = runcmd('patch --dry-run {fp} {patch}'.format(fp=os.path.join(path, dual(fpath)['name']), patch=self.state_file('.tmp.patch')))
+            except TranslationUnavailable as e: # the patch cannot be queued: ask for a manual fix
+                _logger.warning(f'Cannot translate the SUMMARY.md titles. Error: {e}')
+                out, ret = str(e), 1
+            if ret != 0: # dry-run fails. This should not happen
+                plan['errors'].append(f"In commit {remote_last_cid}: Bot failed to modify the dual SUMMARY.md file. Please fix this manually")
+                need_manual_trans.append(dual(fpath)['name'])
+            else: # patch the dual file
+                ops.append(('patch', os.path.join(path, dual(fpath)['name'])))
+                auto_trans.append(dual(fpath)['name'])
+
+        elif sum(is_modif_sum_lang) == 0:
+            if not sp.check_consistency(path=path): # this should never happen
+                plan['errors'].append(f"In commit {remote_last_cid}: nothing changed to lang/SUMMARY.md but inconsistency detected.")
+
+
+        ## ================================================================================
+        ## 2. Then check line by line and handles all detected file changes
+        ## ================================================================================
+        for line in diff_tree:
+            if not (line[1].startswith('zh-hans/') or line[1].startswith('en/')): # files not related to lingual
+                continue
+            if not (line[-1].startswith('zh-hans/') or line[-1].startswith('en/')): # files not related to lingual
+                continue
+            if line[-1].endswith('/SUMMARY.md'): # they are handled already
+                continue
+            fpath = line[-1]
+            absfpath = os.path.join(path, fpath)
+            absfpath_dual = os.path.join(path, dual(fpath)['name'])
+            if not os.path.exists(os.path.dirname(absfpath_dual)): # make dual folder if not exists
+                os.makedirs(os.path.dirname(absfpath_dual))    
+
+            if line[0] == 'D': # case: a file is deleted
+                if fpath not in moved_files: # not moved away
+                    _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} will be removed")
+                    if os.path.exists(absfpath_dual):
+                        ops.append(('remove', absfpath_dual))
+                    if absfpath_dual in queued:
+                        ops.append(('dequeue', absfpath_dual, f'{fpath} is removed'))
+            if line[0] == 'A': # case: a new file is added. We create the dual file.
+                if os.path.exists(absfpath_dual):
+                    plan['errors'].append(f"In commit {remote_last_cid}: {dual(fpath)['name']} should not exist, since {fpath} is just created")
+                if fpath.endswith('.md'): # need translation
+                    if not os.path.exists(dual(fpath)['name']) or (os.path.exists(dual(fpath)['name']) and get_file_last_commit_author(path=path, fpath=dual(fpath)['name'])[0] == args['bot']['author']):
+                        _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} is auto-translated")
+                        add_trans_job(fpath, absfpath, absfpath_dual)
+                    else:
+                        need_manual_trans.append(dual(fpath)['name'])
+                else: # direct copy is fine
+                    ops.append(('copy', absfpath, absfpath_dual))
+
+            elif line[0] == 'M': # case: modify a file. We check if corresponding file was previous modified. Do translation if not.
+                if fpath.endswith('.md'): # need translation
+                    if os.path.exists(absfpath_dual) or absfpath_dual in queued:
+                        if fpath not in moved_files: # not moved away. Means that this is a "real" modification
+                            if dual(fpath)['name'] not in modif_files: # dual file not modified in the same commit
+                                # and its last revision is made by bot (or its translation is queued) => can do auto-translate
+                                if not os.path.exists(absfpath_dual) or get_file_last_commit_author(path=path, fpath=dual(fpath)['name'])[0] == args['bot']['author']:
+                                    _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} is auto-translated")
+                                    add_trans_job(fpath, absfpath, absfpath_dual)
+                                else:
+                                    need_manual_trans.append(dual(fpath)['name'])
+                    else:
+                        plan['errors'].append(f"In commit {remote_last_cid}: {dual(fpath)['name']} should have existed")
+                else: # direct copy is fine (may overide)
+                    ops.append(('copy', absfpath, absfpath_dual))
+
+            elif line[0].startswith('C') or line[0].startswith('R'):
+                fpath_orig = line[1]
+                absfpath_dual_orig = os.path.join(path, dual(fpath_orig)['name'])
+                if os.path.exists(absfpath_dual_orig):
+                    if line[0][1:] == '100': # 100% changed (simply move/copy)
+                        ## Simply move to new dir. The file may be either .md or others
+                        ops.append(('git_mv', dual(fpath_orig)['name'], dual(fpath)['name']))
+                    else: ## despite of pure copy/move, also detect revision
+                        if fpath.endswith('.md'): # need translation
+                            ## Check the latest author of the original dual file (before moving)
+                            if get_file_last_commit_author(path=path, fpath=dual(fpath_orig)['name'])[0] == args['bot']['author']:
+                                add_trans_job(fpath, absfpath, absfpath_dual, absfpath_orig=absfpath_dual_orig)
+                            else:
+                                need_manual_trans.append(dual(fpath)['name']) # warn users that the file needs manual translation
+                                ops.append(('rename', absfpath_dual_orig, absfpath_dual)) # simply rename the original file
+                        else: # direct copy is fine
+                            ops.append(('copy', absfpath, absfpath_dual))
+                elif absfpath_dual_orig in queued and line[0][1:] != '100': # the dual file is not created yet: translate the revised source
+                    _logger.info(f"In commit {remote_last_cid}: {dual(fpath)['name']} is auto-translated")
+                    add_trans_job(fpath, absfpath, absfpath_dual)
+                if absfpath_dual_orig in queued: # the queued translation follows its source
+                    if line[0][1:] == '100':
+                        ops.append(('requeue', absfpath_dual_orig, absfpath, absfpath_dual, line[0].startswith('C')))
+                    elif line[0].startswith('R'):
+                        ops.append(('dequeue', absfpath_dual_orig, f'{fpath_orig} is renamed to {fpath}'))
+        return plan
 
-                ## Finally, do git pull in workarea. The remote can be sync-ed to workarea now
-                git_pull(path=args['workarea']['relpath'], args=args)
+    def apply(self, plan):
+        """Apply the planned file operations to the testarea. Returns the lists of auto-translated and queued dual files"""
+        auto_trans, queued_trans = list(plan['auto_trans']), []
+        for op in plan['ops']:
+            if op[0] == 'patch':
+                runcmd(f"patch {op[1]} {self.state_file('.tmp.patch')}")
+            elif op[0] == 'remove':
+                os.remove(op[1])
+            elif op[0] == 'copy':
+                shutil.copy(op[1], op[2])
+            elif op[0] == 'rename':
+                os.rename(op[1], op[2])
+            elif op[0] == 'git_mv':
+                os.system(f"cd {self.path} && git mv {op[1]} {op[2]} && cd -")
+            elif op[0] == 'dequeue':
+                self.dequeue_trans_job(op[1], reason=op[2])
+            elif op[0] == 'requeue':
+                self.requeue_trans_job(op[1], op[2], op[3], keep=op[4])
+            elif op[0] == 'translate':
+                _, i, name, absfpath_orig = op
+                lang, from_path, to_path = plan['jobs'][i]
+                text = plan['texts'][i]
+                if text is not None:
+                    with open(to_path, 'w') as fw:
+                        fw.write(text)
+                    self.record_translated([from_path])
+                    self.dequeue_trans_job(to_path) # superseded by this translation
+                    auto_trans.append(name)
+                    if absfpath_orig is not None:
+                        os.remove(absfpath_orig) # remove the original
+                else: # backend unavailable: queue the job and leave the dual file untouched
+                    self.queue_trans_job(lang, from_path, to_path)
+                    queued_trans.append(name)
+                    if absfpath_orig is not None: # keep the original translation at the new place until the queued job is done
+                        os.rename(absfpath_orig, to_path)
+        return auto_trans, queued_trans
                 
 
 if __name__ == '__main__':
@@ -364,8 +784,23 @@ if __name__ == '__main__':
         args = yaml.safe_load(f)
         args['mail'] = yaml.safe_load(_f)
     
-    p_test = TestMonitor(args)
-    p_test.launch()
-    p_buld = Builder(args)
-    p_buld.launch()
+    if 'repos' in args: # serve several wikis with one daemon
+        from daemon import MultiRepoMonitor, repo_args, check_repos
+        check_repos(args)
+        p_test = MultiRepoMonitor(args)
+        p_test.launch()
+        for repo in args['repos']:
+            p_buld = Builder(repo_args(args, repo))
+            p_buld.launch()
+            if 'search' in repo_args(args, repo):
+                p_srch = SearchServer(repo_args(args, repo))
+                p_srch.launch()
+    else:
+        p_test = TestMonitor(args)
+        p_test.launch()
+        p_buld = Builder(args)
+        p_buld.launch()
+        if 'search' in args:
+            p_srch = SearchServer(args)
+            p_srch.launch()
     ExternalProcess.monitor_all()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import asyncio
+import copy
+import json
+import os
+from logger import _logger
+from mail import send_mail
+from externalprocess import ExternalProcess
+from scheduler import FairScheduler
+from bot import TestMonitor
+
+
+def repo_args(args, repo):
+    """The configs of one repository: the top-level sections overridden by the repository entry.
+    State files are kept in .state/<name>/ unless the entry sets bot.state_dir
+    """
+    result = copy.deepcopy({k: v for k, v in args.items() if k not in ('repos', 'scheduler', 'webhook')})
+    for key, value in repo.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key].update(copy.deepcopy(value))
+        else:
+            result[key] = copy.deepcopy(value)
+    result['bot'].setdefault('state_dir', os.path.join('.state', repo['name']))
+    result['workarea'].setdefault('lrport', False) # the default livereload port cannot be shared
+    return result
+
+
+def check_repos(args):
+    """Check that the services of the repositories do not share a port. Run before anything is launched,
+    since a launched process would keep the daemon from exiting
+    """
+    used = {}
+    for repo in args['repos']:
+        rargs = repo_args(args, repo)
+        required = [('workarea', 'port')] + ([('search', 'port')] if 'search' in rargs else [])
+        for section, key in required:
+            if key not in repo.get(section, {}):
+                raise SystemExit(f"Please set {section}.{key} for the repository '{repo['name']}' in config.yml")
+        ports = [rargs['workarea']['port'], rargs['workarea']['lrport']] + ([rargs['search']['port']] if 'search' in rargs else [])
+        for port in ports:
+            if port is False:
+                continue
+            if port in used:
+                raise SystemExit(f"The repositories '{used[port]}' and '{repo['name']}' cannot share the port {port}")
+            used[port] = repo['name']
+
+
+class MultiRepoMonitor(ExternalProcess):
+    """Run the TestMonitor of every repository in one event loop. Translation and build slots are shared
+    through a FairScheduler, and a webhook endpoint can wake up a repository before its next poll
+    """
+
+    def __init__(self, args):
+        super(MultiRepoMonitor, self).__init__(args=args, name='multi_repo_monitor')
+
+    def keep(self):
+        ## Run super: record pid
+        super(MultiRepoMonitor, self).keep()
+        try:
+            asyncio.run(self.run())
+        finally: # atexit handlers do not run in a launched process
+            for monitor in getattr(self, 'monitors', {}).values():
+                monitor.close_translators()
+
+    async def run(self):
+        args = self.args
+        slots = args.get('scheduler', {})
+        self.scheduler = FairScheduler({'translate': slots.get('translate_slots', 2), 'build': slots.get('build_slots', 1)})
+        self.monitors = {}
+        for repo in args['repos']:
+            self.scheduler.register(repo['name'], priority=repo.get('priority', 1))
+            self.monitors[repo['name']] = TestMonitor(repo_args(args, repo), scheduler=self.scheduler)
+
+        if 'webhook' in args:
+            self.webhook_server = await asyncio.start_server(self.handle_webhook, args['webhook'].get('host', '0.0.0.0'), args['webhook']['port'])
+            _logger.info(f"Webhook listening on port {args['webhook']['port']}")
+        tasks = [asyncio.create_task(self.run_repo(name, monitor)) for name, monitor in self.monitors.items()]
+        await asyncio.gather(*tasks)
+        self.errormsg.value = 'All repositories are halted'
+
+    async def run_repo(self, name, monitor):
+        """A failure in one repository is reported, and does not stop the others"""
+        try:
+            await monitor.run()
+        except Exception as e:
+            subject = f"Wiki error: repository '{name}' is halted"
+            _logger.error(f'{subject}: {type(e).__name__}: {e}')
+            await asyncio.to_thread(send_mail, subject=subject, text=f'{type(e).__name__}: {e}', args=monitor.args)
+
+    async def handle_webhook(self, reader, writer):
+        """POST /hook/<name> (e.g. a GitLab push hook) wakes up the monitor of that repository. GET /stats reports the scheduler"""
+        async def reply(status, body=''):
+            body = body.encode()
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+            writer.close()
+        try:
+            method, target, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if line == '':
+                    break
+                k, _, v = line.partition(':')
+                headers[k.strip().lower()] = v.strip()
+            await reader.readexactly(int(headers.get('content-length', 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            return await reply('400 Bad Request')
+
+        if method == 'GET' and target == '/stats':
+            return await reply('200 OK', json.dumps(self.scheduler.stats()))
+        name = target[len('/hook/'):] if target.startswith('/hook/') else None
+        if method != 'POST' or name not in self.monitors:
+            return await reply('404 Not Found')
+        token = self.args['webhook'].get('token', '')
+        if token and headers.get('x-gitlab-token') != token:
+            return await reply('403 Forbidden')
+        monitor = self.monitors[name]
+        if hasattr(monitor, 'wakeup'): # set up already
+            monitor.wakeup.set()
+        await reply('200 OK', '{}')
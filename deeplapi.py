@@ -0,0 +1,240 @@
+import asyncio
+import http.client
+import json
+import queue
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode, urlsplit
+from logger import _logger
+
+
+class QuotaExceededError(RuntimeError):
+    """Raised when the DeepL character quota does not allow the request"""
+
+
+class DeepLAPIError(RuntimeError):
+    """Raised when the DeepL API keeps failing after all retries"""
+
+
+def parse_retry_after(value, default):
+    """Parse a Retry-After header (either delay-seconds or an HTTP date) into seconds"""
+
+    if value is None:
+        return default
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class DeepLAPIClient(object):
+    """Client of the DeepL HTTP API (/v2/translate, /v2/usage).
+    Keeps a pool of keep-alive connections; batches are sent concurrently with asyncio.
+    Example:
+        client = DeepLAPIClient(auth_key='xxx:fx')
+        client.translate(['Hello', 'World'], target_lang='zh', source_lang='en')
+    """
+
+    ## Limits of a single /v2/translate request
+    max_texts_per_request = 50
+    max_bytes_per_request = 120 * 1024
+
+    def __init__(self, auth_key='', url='https://api-free.deepl.com', pool_size=4, batch_size=50, batch_chars=30000,
+                 timeout=30, max_retries=5, backoff=1., check_quota=True, usage_refresh=60.):
+        parsed = urlsplit(url)
+        self.scheme = parsed.scheme or 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.prefix = parsed.path.rstrip('/')
+        self.auth_key = auth_key
+        self.pool_size = pool_size
+        self.batch_size = min(batch_size, self.max_texts_per_request)
+        self.batch_chars = batch_chars
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.check_quota = check_quota
+        self.usage_refresh = usage_refresh
+        self._pool = queue.LifoQueue()
+        self._n_conn = 0
+        self._lock = threading.Lock()
+        self._chars_used = None
+        self._chars_limit = None
+        self._usage_time = 0. # when usage() was last fetched
+
+    ## ----------------------------------------------------------------------
+    ## Connection pool
+    ## ----------------------------------------------------------------------
+    def _new_connection(self):
+        conn_cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return conn_cls(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._n_conn < self.pool_size:
+                    self._n_conn += 1
+                    return self._new_connection()
+            return self._pool.get()
+
+    def _release(self, conn):
+        self._pool.put(conn)
+
+    def close(self):
+        """Close all pooled connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._n_conn = 0
+
+    def _request(self, method, path, params=None):
+        """Send one request over a pooled connection. Returns (status, headers, body)"""
+
+        headers = {'Authorization': f'DeepL-Auth-Key {self.auth_key}', 'Connection': 'keep-alive'}
+        body = None
+        if params is not None:
+            body = urlencode(params, doseq=True).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn = self._acquire()
+        try:
+            for attempt in range(2): # a kept-alive connection may be dropped by the server: reconnect once
+                try:
+                    conn.request(method, self.prefix + path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    return resp.status, resp.headers, resp.read()
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    conn = self._new_connection()
+                    if attempt == 1:
+                        raise
+        finally:
+            self._release(conn)
+
+    ## ----------------------------------------------------------------------
+    ## Quota
+    ## ----------------------------------------------------------------------
+    def usage(self):
+        """Fetch the character usage of the current billing period"""
+
+        status, _, body = self._request('GET', '/v2/usage')
+        if status != 200:
+            raise DeepLAPIError(f'Cannot fetch DeepL usage. Status: {status}, body: {body[:200]}')
+        res = json.loads(body)
+        with self._lock:
+            self._chars_used, self._chars_limit = res.get('character_count', 0), res.get('character_limit', 0)
+            self._usage_time = time.monotonic()
+        return res
+
+    def _check_quota(self, n_chars):
+        """Raise QuotaExceededError if the request would exceed the quota. The server usage is fetched again
+        every 'usage_refresh' seconds (other clients, a renewed billing period); in between, the characters
+        of the successful requests are counted locally
+        """
+        if not self.check_quota:
+            return
+        if time.monotonic() - self._usage_time > self.usage_refresh:
+            self.usage()
+        if self._chars_limit and self._chars_used + n_chars > self._chars_limit:
+            raise QuotaExceededError(f'DeepL quota exceeded: {self._chars_used}+{n_chars} > {self._chars_limit} characters')
+
+    def _charge(self, n_chars):
+        with self._lock:
+            if self._chars_used is not None:
+                self._chars_used += n_chars
+
+    ## ----------------------------------------------------------------------
+    ## Translation
+    ## ----------------------------------------------------------------------
+    @staticmethod
+    def lang_code(lang, is_target):
+        lang = lang.upper()
+        if is_target and lang == 'EN':
+            return 'EN-US' # plain 'EN' is deprecated as a target
+        return lang
+
+    def make_batches(self, segments):
+        """Group segment indices into batches that respect the per-request limits"""
+
+        batches, cur, cur_chars = [], [], 0
+        for i, seg in enumerate(segments):
+            n = len(seg.encode('utf-8'))
+            if cur and (len(cur) >= self.batch_size or cur_chars + n > min(self.batch_chars, self.max_bytes_per_request)):
+                batches.append(cur)
+                cur, cur_chars = [], 0
+            cur.append(i)
+            cur_chars += n
+        if cur:
+            batches.append(cur)
+        return batches
+
+    async def _translate_batch(self, texts, target_lang, source_lang):
+        params = [('text', t) for t in texts] + [
+            ('target_lang', self.lang_code(target_lang, True)),
+            ('source_lang', self.lang_code(source_lang, False)),
+            ('preserve_formatting', '1'),
+        ]
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, headers, body = await asyncio.to_thread(self._request, 'POST', '/v2/translate', params)
+            except (http.client.HTTPException, OSError) as e: # network error, or a broken response on the reconnection
+                status, headers, body = None, {}, str(e).encode()
+            if status == 200:
+                self._charge(sum(len(t) for t in texts))
+                return [t['text'] for t in json.loads(body)['translations']]
+            if status == 456:
+                self._usage_time = 0. # the local count is wrong: fetch the usage again on the next call
+                raise QuotaExceededError('DeepL quota exceeded (HTTP 456)')
+            if status in (403, 400, 413):
+                raise DeepLAPIError(f'DeepL request rejected. Status: {status}, body: {body[:200]}')
+            ## 429 / 5xx / network error: honour Retry-After, otherwise back off exponentially
+            if attempt < self.max_retries:
+                wait = parse_retry_after(headers.get('Retry-After'), self.backoff * 2 ** attempt)
+                _logger.warning(f'DeepL API status: {status}. Retry in {wait:.1f} s ({attempt+1}/{self.max_retries})')
+                await asyncio.sleep(wait)
+        raise DeepLAPIError(f'DeepL request failed after {self.max_retries} retries. Last status: {status}')
+
+    async def translate_async(self, segments, target_lang, source_lang):
+        """Translate a list of segments. Returns the translated list in the same order"""
+
+        segments = list(segments)
+        result = list(segments)
+        todo = [i for i, seg in enumerate(segments) if seg.strip() != '']
+        if not todo:
+            return result
+        await asyncio.to_thread(self._check_quota, sum(len(segments[i]) for i in todo))
+
+        sem = asyncio.Semaphore(self.pool_size)
+        async def run(batch):
+            async with sem:
+                out = await self._translate_batch([segments[todo[i]] for i in batch], target_lang, source_lang)
+            for i, t in zip(batch, out):
+                result[todo[i]] = t
+
+        await asyncio.gather(*[run(b) for b in self.make_batches([segments[i] for i in todo])])
+        return result
+
+    def translate(self, segments, target_lang, source_lang):
+        """Blocking wrapper of translate_async"""
+        return asyncio.run(self.translate_async(segments, target_lang, source_lang))
+
+
+## Clients shared by all translators, per configs
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_api_client(**configs):
+    """Get the shared client (hence the shared connection pool and quota count) for the given configs"""
+    key = json.dumps(configs, sort_keys=True)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = DeepLAPIClient(**configs)
+        return _clients[key]
@@ -94,4 +94,47 @@ def git_push(path='.', msg='', **kwargs):
     author, email = args['bot']['author'], args['bot']['email']
     subprocess.check_output(f'cd {path} && git add . && git commit -m "{msg}" --author="{author} <{email}>" && {get_extra_git_ssh_cmd(args)} git push origin master', 
                             shell=True, universal_newlines=True, timeout=60) ## set timeout
-    
\ No newline at end of file
+    
+def get_commit_time(path='.', commit_id='HEAD'):
+    """Get the committer timestamp (in seconds) of a given commit"""
+
+    _logger.debug(f'Enter get_commit_time. commit_id: {commit_id}')
+    out = subprocess.check_output(f'cd {path} && git log -1 --format=%ct {commit_id}',
+                            shell=True, universal_newlines=True, timeout=60) ## set timeout
+    return int(out.strip())
+
+def git_blob_hash(data):
+    """The git object id of a blob with the given content (bytes), as 'git hash-object' gives"""
+
+    import hashlib
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def get_last_commits(path='.', paths=('en', 'zh-hans')):
+    """Get the last commit (cid, author, timestamp) that touches each file under 'paths', in one git log pass.
+    'order' is the position of that commit in the log, newest first: unlike the timestamps, it is reliable for
+    same-second commits and skewed clocks
+    """
+
+    _logger.debug(f'Enter get_last_commits. paths: {paths}')
+    out = subprocess.check_output(f"cd {path} && git log --topo-order --format='%x00%H%x09%an%x09%ct' --name-only -- {' '.join(paths)}",
+                            shell=True, universal_newlines=True, timeout=600) ## set timeout
+    result = {}
+    for order, entry in enumerate(out.split('\x00')[1:]):
+        header, _, files = entry.partition('\n')
+        cid, author, ctime = header.split('\t')
+        for fpath in files.split('\n'):
+            if fpath != '' and fpath not in result: # git log goes from the newest
+                result[fpath] = {'cid': cid, 'author': author, 'time': int(ctime), 'order': order}
+    return result
+
+def get_blob_hashes(path='.', paths=('en', 'zh-hans')):
+    """Get the git blob hash of each file under 'paths' at HEAD"""
+
+    _logger.debug(f'Enter get_blob_hashes. paths: {paths}')
+    out = subprocess.check_output(f"cd {path} && git ls-tree -r HEAD -- {' '.join(paths)}",
+                            shell=True, universal_newlines=True, timeout=60) ## set timeout
+    result = {}
+    for line in out.split('\n')[:-1]:
+        meta, fpath = line.split('\t', 1) # e.g. '100644 blob e69de29...\ten/a.md'
+        result[fpath] = meta.split()[2]
+    return result
@@ -0,0 +1,180 @@
+import re
+import threading
+import yaml
+from logger import _logger
+
+PLACEHOLDER = '#G{:05d}#'
+RGX_PLACEHOLDER = re.compile(r'#\s*G\s*(\d{5})\s*#') # DeepL may insert spaces in a placeholder
+## Spans where the terms are left untouched: inline code, link targets and bare urls
+RGX_PROTECT = re.compile(r'`[^`\n]*`|\]\([^)\n]*\)|https?://[^\s)]+')
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz') # keeps the text length
+
+def is_word_char(c):
+    return c.isascii() and (c.isalnum() or c == '_')
+
+
+class TermMatcher(object):
+    """Aho-Corasick automaton over a set of terms: finds all the occurrences in one pass over the text,
+    independently of the number of terms
+    """
+
+    def __init__(self, terms, ignore_case=False):
+        self.ignore_case = ignore_case
+        self.goto = [{}]  # node -> {char: node}
+        self.fail = [0]
+        self.out = [-1]   # node -> index of the term ending here, or -1
+        self.link = [0]   # node -> nearest node on the failure chain with a term (0 if none)
+        self.lengths = []
+        for idx, term in enumerate(terms):
+            self._insert(self._norm(term), idx)
+            self.lengths.append(len(term))
+        self._build()
+
+    def _norm(self, text):
+        return text.translate(ASCII_LOWER) if self.ignore_case else text
+
+    def _insert(self, term, idx):
+        node = 0
+        for c in term:
+            nxt = self.goto[node].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][c] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(-1)
+                self.link.append(0)
+            node = nxt
+        if self.out[node] == -1: # duplicated term: the first entry wins
+            self.out[node] = idx
+
+    def _build(self):
+        """Breadth-first construction of the failure and output links"""
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for c, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(c, 0)
+                self.link[child] = self.fail[child] if self.out[self.fail[child]] != -1 else self.link[self.fail[child]]
+                queue.append(child)
+
+    def finditer(self, text):
+        """Yield (start, end, term index) for every occurrence, overlapping ones included"""
+        goto, fail, out, link, lengths = self.goto, self.fail, self.out, self.link, self.lengths
+        node = 0
+        for i, c in enumerate(self._norm(text)):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            hit = node if out[node] != -1 else link[node]
+            while hit:
+                idx = out[hit]
+                yield i + 1 - lengths[idx], i + 1, idx
+                hit = link[hit]
+
+
+class Glossary(object):
+    """A bilingual glossary of the terms DeepL should not translate freely (physics terms, detector names, macros).
+    Before translation, the terms of the source language are frozen into placeholders; after translation the
+    placeholders are replaced by the terms of the target language. An entry without a translation is kept as is.
+    Example:
+        glossary = Glossary([{'en': 'jet energy scale', 'zh': '喷注能标'}, {'en': 'CMSSW'}])
+        frozen = glossary.freeze('Check the jet energy scale.', 'en')  # 'Check the #G00000#.'
+        glossary.restore('检查#G00000#。', 'zh')                        # '检查喷注能标。'
+    """
+
+    def __init__(self, entries=(), langs=('en', 'zh'), ignore_case=False):
+        self.langs = langs
+        self.entries = []
+        for entry in entries:
+            terms = {lang: str(entry[lang]) for lang in langs if entry.get(lang)}
+            if len(terms) == 0:
+                continue
+            fallback = next(iter(terms.values()))
+            self.entries.append({lang: terms.get(lang, fallback) for lang in langs})
+        ## One automaton per source language, built upfront as the translators share the glossary among threads
+        self.matchers = {lang: TermMatcher([e[lang] for e in self.entries], ignore_case=ignore_case) for lang in langs}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, text, lang):
+        """Leftmost-longest non-overlapping occurrences [(start, end, entry index)] of the terms of 'lang',
+        whole words only for ASCII terms, and outside of inline code and links
+        """
+        best = {} # start -> (end, idx)
+        for start, end, idx in self.matchers[lang].finditer(text):
+            if start > 0 and is_word_char(text[start]) and is_word_char(text[start-1]):
+                continue
+            if end < len(text) and is_word_char(text[end-1]) and is_word_char(text[end]):
+                continue
+            if start not in best or end > best[start][0]:
+                best[start] = (end, idx)
+
+        protected = [m.span() for m in RGX_PROTECT.finditer(text)]
+        result, last_end, ip = [], 0, 0
+        for start in sorted(best):
+            end, idx = best[start]
+            if start < last_end:
+                continue
+            while ip < len(protected) and protected[ip][1] <= start:
+                ip += 1
+            if ip < len(protected) and protected[ip][0] < end: # overlaps a protected span
+                continue
+            result.append((start, end, idx))
+            last_end = end
+        return result
+
+    def freeze(self, text, source_lang):
+        """Replace the terms of the source language by placeholders"""
+        if len(self.entries) == 0:
+            return text
+        pieces, pos = [], 0
+        for start, end, idx in self.find(text, source_lang):
+            pieces += [text[pos:start], PLACEHOLDER.format(idx)]
+            pos = end
+        pieces.append(text[pos:])
+        return ''.join(pieces)
+
+    def restore(self, text, target_lang):
+        """Replace the placeholders by the terms of the target language"""
+        if len(self.entries) == 0:
+            return text
+        def _replace(match):
+            idx = int(match.group(1))
+            if idx >= len(self.entries):
+                _logger.warning(f'Unknown glossary placeholder in the translation: {match.group(0)}')
+                return match.group(0)
+            return self.entries[idx][target_lang]
+        return RGX_PLACEHOLDER.sub(_replace, text)
+
+
+## Glossaries shared by all translators, per config file
+_glossaries = {}
+_glossaries_lock = threading.Lock()
+
+def get_glossary(configs):
+    """The glossary from the 'translator.glossary' configs: either a yaml file with a list of entries
+    ({en: ..., zh: ...}), or a dict {'file': <yaml file>, 'entries': [...], 'ignore_case': false}. Returns None if not configured
+    """
+    if not configs:
+        return None
+    if isinstance(configs, str):
+        configs = {'file': configs}
+    key = (configs.get('file'), configs.get('ignore_case', False))
+    if 'entries' in configs: # inline entries are not cached
+        key = None
+    with _glossaries_lock:
+        if key is not None and key in _glossaries:
+            return _glossaries[key]
+        entries = list(configs.get('entries', []))
+        if configs.get('file'):
+            with open(configs['file']) as f:
+                entries += yaml.safe_load(f) or []
+        glossary = Glossary(entries, ignore_case=configs.get('ignore_case', False))
+        _logger.info(f'Glossary loaded: {len(glossary)} entries')
+        if key is not None:
+            _glossaries[key] = glossary
+        return glossary
@@ -34,9 +34,14 @@ def send_mail(subject='', text='', receiver=None, bcc_admin=False, args=None):
 
         ## Send email
         if not mail_args['dry_run']:
-            smtpObj = smtplib.SMTP_SSL(smtp_host, smtp_port)
-            smtpObj.login(smtp_address, smtp_password)
+            if mail_args.get('smtp_ssl', True):
+                smtpObj = smtplib.SMTP_SSL(smtp_host, smtp_port)
+            else: # e.g. a local SMTP sink
+                smtpObj = smtplib.SMTP(smtp_host, smtp_port)
+            if smtp_password:
+                smtpObj.login(smtp_address, smtp_password)
             smtpObj.sendmail(smtp_address, receiver+receiver_bcc, message.as_string())
+            smtpObj.quit()
         print("Email sent:\nFrom: {sender}\nTo: {receiver}\nBcc: {bcc}\nSubject: {subject}\nText:\n{text}".format(
             sender=f'{smtp_username} <{smtp_address}>',
             receiver=','.join(receiver),
@@ -0,0 +1,122 @@
+"""A local mock of the DeepL HTTP API, so that the API backend and its benchmark run offline.
+    python mockdeepl.py --port 8091 --latency 0.05
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class MockDeepLHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, obj=None, headers={}):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8') if obj is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        srv = self.server
+        if urlsplit(self.path).path != '/v2/usage':
+            return self._reply(404, {'message': 'Not found'})
+        self._reply(200, {'character_count': srv.chars_used, 'character_limit': srv.chars_limit})
+
+    def do_POST(self):
+        srv = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+        if urlsplit(self.path).path != '/v2/translate':
+            return self._reply(404, {'message': 'Not found'})
+        if srv.auth_key and self.headers.get('Authorization') != f'DeepL-Auth-Key {srv.auth_key}':
+            return self._reply(403, {'message': 'Wrong auth key'})
+
+        with srv.lock:
+            srv.n_requests += 1
+            n_req = srv.n_requests
+        if srv.throttle_every and n_req % srv.throttle_every == 0:
+            return self._reply(429, {'message': 'Too many requests'}, headers={'Retry-After': str(srv.retry_after)})
+
+        texts = params.get('text', [])
+        n_chars = sum(len(t) for t in texts)
+        with srv.lock:
+            if srv.chars_limit and srv.chars_used + n_chars > srv.chars_limit:
+                return self._reply(456, {'message': 'Quota exceeded'})
+            srv.chars_used += n_chars
+        time.sleep(srv.latency + srv.latency_per_char * n_chars)
+
+        target_lang = params.get('target_lang', [''])[0]
+        source_lang = params.get('source_lang', [''])[0]
+        self._reply(200, {'translations': [
+            {'detected_source_language': source_lang, 'text': srv.translate(t, target_lang)} for t in texts
+        ]})
+
+
+class MockDeepLServer(ThreadingHTTPServer):
+    """Threaded mock server. The "translation" tags each text with the target language.
+    Example:
+        srv = MockDeepLServer(port=0, latency=0.05).start()
+        url = srv.url # use as DeepLAPIClient(url=url)
+        srv.stop()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, auth_key='', latency=0., latency_per_char=0.,
+                 throttle_every=0, retry_after=0, chars_limit=0):
+        super(MockDeepLServer, self).__init__((host, port), MockDeepLHandler)
+        self.auth_key = auth_key
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.chars_limit = chars_limit
+        self.chars_used = 0
+        self.n_requests = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def translate(text, target_lang):
+        return f'[{target_lang}] {text}'
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local mock DeepL API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--auth-key', default='')
+    parser.add_argument('--latency', type=float, default=0., help='fixed latency per request (s)')
+    parser.add_argument('--latency-per-char', type=float, default=0., help='extra latency per character (s)')
+    parser.add_argument('--throttle-every', type=int, default=0, help='reply 429 to every n-th request')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent along with 429')
+    parser.add_argument('--chars-limit', type=int, default=0, help='character quota (0: unlimited)')
+    opts = parser.parse_args()
+    srv = MockDeepLServer(
+        host=opts.host, port=opts.port, auth_key=opts.auth_key, latency=opts.latency, latency_per_char=opts.latency_per_char,
+        throttle_every=opts.throttle_every, retry_after=opts.retry_after, chars_limit=opts.chars_limit,
+    )
+    print(f'Mock DeepL API serving on {srv.url}')
+    srv.serve_forever()
@@ -0,0 +1,163 @@
+import threading
+import time
+from logger import _logger
+
+
+class TranslationUnavailable(RuntimeError):
+    """Raised when a translation backend is failing or its circuit is open. The job should be queued for retry"""
+
+
+class AdaptiveRateLimiter(object):
+    """A token bucket whose refill rate adapts to the observed failures and latency (AIMD):
+    the rate increases additively on fast successes and decreases multiplicatively on failures or slow calls
+    """
+
+    def __init__(self, rate=1., burst=5, min_rate=0.01, max_rate=10., increase=0.1, decrease=0.5, slow_latency=20.):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self, latency):
+        with self.lock:
+            if latency > self.slow_latency:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_failure(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class CircuitBreaker(object):
+    """Open the circuit after 'failure_threshold' consecutive failures. After 'reset_timeout' seconds,
+    let one trial call through (half-open): close the circuit if it succeeds, re-open it otherwise
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=300.):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.n_fail = 0
+        self.opened_at = 0.
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def on_success(self):
+        with self.lock:
+            self.state, self.n_fail = self.CLOSED, 0
+
+    def on_failure(self):
+        with self.lock:
+            self.n_fail += 1
+            if self.state == self.HALF_OPEN or self.n_fail >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    _logger.warning(f'Circuit opened after {self.n_fail} failure(s). Pause for {self.reset_timeout} s')
+                self.state, self.opened_at = self.OPEN, time.monotonic()
+
+
+class BackendGuard(object):
+    """Rate limiter, circuit breaker and health stats around one translation backend"""
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=300., **limiter_configs):
+        self.name = name
+        self.limiter = AdaptiveRateLimiter(**limiter_configs)
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.n_call, self.n_fail, self.n_rejected = 0, 0, 0
+        self.total_latency = 0.
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        """Whether a call may go through now (without consuming the half-open trial)"""
+        return self.breaker.state != CircuitBreaker.OPEN or time.monotonic() - self.breaker.opened_at >= self.breaker.reset_timeout
+
+    def call(self, func, text):
+        """Call func(text). An exception or an empty result for a non-empty text counts as a failure"""
+
+        if not self.breaker.allow():
+            with self.lock:
+                self.n_rejected += 1
+            raise TranslationUnavailable(f"Backend '{self.name}' is paused (circuit open)")
+        self.limiter.acquire()
+        start = time.monotonic()
+        try:
+            result = func(text)
+            if text.strip() != '' and not result:
+                raise RuntimeError('empty translation')
+        except Exception as e:
+            self.limiter.on_failure()
+            self.breaker.on_failure()
+            with self.lock:
+                self.n_call += 1
+                self.n_fail += 1
+                self.last_error = f'{type(e).__name__}: {e}'
+            raise TranslationUnavailable(f"Backend '{self.name}' failed. Error: {e}") from e
+        latency = time.monotonic() - start
+        self.limiter.on_success(latency)
+        self.breaker.on_success()
+        with self.lock:
+            self.n_call += 1
+            self.total_latency += latency
+        return result
+
+    def stats(self):
+        with self.lock:
+            n_ok = self.n_call - self.n_fail
+            return {
+                'state': self.breaker.state,
+                'rate': round(self.limiter.rate, 4),
+                'calls': self.n_call,
+                'failures': self.n_fail,
+                'rejected': self.n_rejected,
+                'mean_latency': round(self.total_latency / n_ok, 3) if n_ok > 0 else None,
+                'last_error': self.last_error,
+            }
+
+
+## Guards are shared by all translator instances of the process
+_guards = {}
+_guards_lock = threading.Lock()
+
+def get_guard(name, **configs):
+    """Get the shared guard of a backend. The configs only take effect on the first call"""
+    with _guards_lock:
+        if name not in _guards:
+            _guards[name] = BackendGuard(name, **configs)
+        return _guards[name]
+
+def health_stats():
+    """Health stats of all backends, e.g. {'deepl-api': {'state': 'closed', 'calls': 10, ...}}"""
+    with _guards_lock:
+        return {name: guard.stats() for name, guard in _guards.items()}
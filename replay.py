@@ -0,0 +1,230 @@
+"""Offline replay of a git history range through the full TestMonitor logic, for performance regression tests.
+Commits are replayed one by one onto a local bare remote; mails go to a local SMTP sink.
+    python replay.py --repo ../hepwiki.git --range v1.0..master --latency 0.5 --build-cmd 'gitbook build'
+"""
+import argparse
+import asyncio
+import json
+import os, shutil, subprocess, time
+import socketserver
+import statistics
+import threading
+from logger import _logger
+from bot import TestMonitor
+from translator import DummyTranslator, LatencyTranslator
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Speak just enough SMTP for smtplib.sendmail, and keep the messages in memory"""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.reply('220 localhost SMTP sink')
+        data, in_data = [], False
+        for raw in self.rfile:
+            line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    in_data = False
+                    with self.server.lock:
+                        self.server.messages.append('\n'.join(data))
+                    data = []
+                    self.reply('250 OK')
+                else:
+                    data.append(line[1:] if line.startswith('..') else line)
+                continue
+            cmd = line[:4].upper()
+            if cmd in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif cmd == 'DATA':
+                in_data = True
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif cmd == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else: # MAIL, RCPT, RSET, NOOP...
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super(SMTPSink, self).__init__((host, port), SMTPSinkHandler)
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ReplayMonitor(TestMonitor):
+    """TestMonitor with a dummy (optionally latency-injecting) translator"""
+
+    def __init__(self, args, latency=0.):
+        super(ReplayMonitor, self).__init__(args)
+        self.latency = latency
+
+    def make_translator(self):
+        if self.latency > 0:
+            return LatencyTranslator(latency=self.latency, do_post=True, support_mkdown=True)
+        return DummyTranslator(do_post=True, support_mkdown=True)
+
+
+def git(cmd, cwd, env=None):
+    return subprocess.check_output(f'git {cmd}', shell=True, cwd=cwd, universal_newlines=True, env=env)
+
+
+class Replay(object):
+    """Replay the commits of 'rev_range' in 'repo' through ReplayMonitor. Commits authored by the bot are skipped,
+    since the replayed bot produces its own
+    """
+
+    def __init__(self, repo, rev_range, workdir, latency=0., build_cmd='gitbook build', init_cmd='gitbook init && gitbook install',
+                 bot_author='wikibot', include_bot_commits=False):
+        self.repo = os.path.abspath(repo)
+        self.rev_range = rev_range
+        self.workdir = os.path.abspath(workdir)
+        self.latency = latency
+        self.bot_author = bot_author
+        self.include_bot_commits = include_bot_commits
+        self.remote = os.path.join(self.workdir, 'remote.git')
+        self.seed = os.path.join(self.workdir, 'seed')
+        self.args = {
+            'gitlab': {'home': 'http://gitlab.invalid'},
+            'testarea': {'relpath': os.path.join(self.workdir, 'testarea'), 'git_remote': self.remote,
+                         'build_cmd': build_cmd, 'init_cmd': init_cmd},
+            'workarea': {'relpath': os.path.join(self.workdir, 'workarea'), 'git_remote': self.remote},
+            'bot': {'author': bot_author, 'email': 'wikibot@localhost', 'commit_prefix': '[Bot] '},
+            'translator': {'backend': 'dummy'},
+        }
+
+    def setup(self):
+        """Create the local bare remote at the base commit, the testarea and the workarea"""
+        base, _ = self.rev_range.split('..')
+        if os.path.exists(self.workdir):
+            shutil.rmtree(self.workdir)
+        os.makedirs(self.workdir)
+        git(f'init -q --bare {self.remote}', cwd=self.workdir)
+        git(f'push -q {self.remote} {base}:refs/heads/master', cwd=self.repo)
+        git(f'clone -q {self.remote} seed', cwd=self.workdir)
+        git(f'fetch -q {self.repo}', cwd=self.seed)
+        ## The bot commits in the testarea: give the clones the bot identity, so that no global git config is needed
+        for area in ('testarea', 'workarea'):
+            git(f'clone -q {self.remote} {area}', cwd=self.workdir)
+            git(f"config user.name '{self.bot_author}'", cwd=os.path.join(self.workdir, area))
+            git(f"config user.email '{self.args['bot']['email']}'", cwd=os.path.join(self.workdir, area))
+
+    def commits(self):
+        out = git(f'rev-list --reverse --first-parent {self.rev_range}', cwd=self.repo)
+        result = []
+        for cid in out.split():
+            author = git(f'log -1 --format=%an {cid}', cwd=self.repo).strip()
+            if author == self.bot_author and not self.include_bot_commits:
+                continue
+            result.append(cid)
+        return result
+
+    def push_commit(self, cid):
+        """Overlay the files changed by the commit onto the remote head, and push with the original author and message"""
+        git('pull -q origin master', cwd=self.seed)
+        for line in git(f'diff --name-status --no-renames {cid}^ {cid}', cwd=self.seed).split('\n')[:-1]:
+            status, fpath = line.split('\t', 1)
+            if status == 'D':
+                git(f'rm -q --ignore-unmatch -- "{fpath}"', cwd=self.seed)
+            else:
+                git(f'checkout {cid} -- "{fpath}"', cwd=self.seed)
+        name, email, msg = git(f'log -1 --format=%an%x00%ae%x00%B {cid}', cwd=self.seed).split('\x00', 2)
+        env = dict(os.environ, GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email, GIT_COMMITTER_NAME=name, GIT_COMMITTER_EMAIL=email)
+        with open(os.path.join(self.workdir, '.commit_msg'), 'w') as fw:
+            fw.write(msg)
+        git(f'commit -q --allow-empty -F {os.path.join(self.workdir, ".commit_msg")}', cwd=self.seed, env=env)
+        git('push -q origin master', cwd=self.seed)
+
+    async def run(self):
+        self.setup()
+        sink = SMTPSink().start()
+        self.args['mail'] = {
+            'smtp_host': sink.server_address[0], 'smtp_port': sink.server_address[1], 'smtp_ssl': False,
+            'smtp_address': 'wikibot@localhost', 'smtp_username': 'wikibot', 'smtp_password': '',
+            'receiver_admin': ['admin@localhost'], 'dry_run': False,
+        }
+        cwd = os.getcwd()
+        os.chdir(self.workdir) # the monitor keeps its state files in cwd
+        monitor = ReplayMonitor(self.args, latency=self.latency)
+        try:
+            with monitor.stage('setup'):
+                await monitor.setup()
+            report = {'setup': monitor.timings.pop('setup'), 'commits': []}
+            for cid in self.commits():
+                await asyncio.to_thread(self.push_commit, cid)
+                start = time.perf_counter()
+                await monitor.poll()
+                critical = time.perf_counter() - start
+                await monitor.drain()
+                timings = {k: v for k, v in monitor.timings.items() if k not in ('detected', 'published')}
+                timings.update({'critical_path': critical, 'total': time.perf_counter() - start})
+                report['commits'].append({'cid': cid, 'timings': timings})
+                _logger.info(f'Replayed {cid[:8]}: ' + ', '.join(f'{k}: {v:.2f} s' for k, v in timings.items()))
+            report['n_mails'] = len(sink.messages)
+        finally:
+            monitor.close_translators()
+            os.chdir(cwd)
+            sink.stop()
+        report['aggregate'] = aggregate([c['timings'] for c in report['commits']])
+        return report
+
+
+def aggregate(timings_list):
+    """Per stage: count, mean, median, p90, max and sum of the durations"""
+    stages = {}
+    for timings in timings_list:
+        for k, v in timings.items():
+            stages.setdefault(k, []).append(v)
+    result = {}
+    for k, vals in stages.items():
+        vals = sorted(vals)
+        result[k] = {
+            'n': len(vals), 'mean': statistics.mean(vals), 'median': statistics.median(vals),
+            'p90': vals[min(len(vals)-1, int(0.9*len(vals)))], 'max': vals[-1], 'sum': sum(vals),
+        }
+    return result
+
+
+def print_report(report):
+    print(f"\nSetup: {report['setup']:.2f} s. Commits replayed: {len(report['commits'])}. Mails sent: {report['n_mails']}")
+    print(f"{'stage':<15}{'n':>5}{'mean':>10}{'median':>10}{'p90':>10}{'max':>10}{'sum':>10}")
+    for k, s in report['aggregate'].items():
+        print(f"{k:<15}{s['n']:>5}{s['mean']:>10.3f}{s['median']:>10.3f}{s['p90']:>10.3f}{s['max']:>10.3f}{s['sum']:>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a git history range through the bot, offline')
+    parser.add_argument('--repo', required=True, help='local (bare) repository of the wiki')
+    parser.add_argument('--range', required=True, dest='rev_range', help='commit range, e.g. base..head')
+    parser.add_argument('--workdir', default='.replay', help='scratch directory (wiped)')
+    parser.add_argument('--latency', type=float, default=0., help='latency injected per translation (s)')
+    parser.add_argument('--build-cmd', default='gitbook build')
+    parser.add_argument('--init-cmd', default='gitbook init && gitbook install')
+    parser.add_argument('--bot-author', default='wikibot')
+    parser.add_argument('--include-bot-commits', action='store_true')
+    parser.add_argument('--json', help='also write the report to this file')
+    opts = parser.parse_args()
+
+    replay = Replay(
+        opts.repo, opts.rev_range, opts.workdir, latency=opts.latency, build_cmd=opts.build_cmd, init_cmd=opts.init_cmd,
+        bot_author=opts.bot_author, include_bot_commits=opts.include_bot_commits,
+    )
+    report = asyncio.run(replay.run())
+    print_report(report)
+    if opts.json:
+        with open(opts.json, 'w') as fw:
+            json.dump(report, fw, indent=1)
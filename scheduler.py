@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+from logger import _logger
+
+
+class FairScheduler(object):
+    """Share a limited number of slots of each resource (e.g. 'translate', 'build') among repositories.
+    Waiting requests are served by start-time fair queuing: each slot a repository takes advances
+    its virtual time by 1/priority, so a repository with priority 2 gets twice the share under contention
+    Example:
+        scheduler = FairScheduler({'translate': 2, 'build': 1})
+        scheduler.register('hepwiki', priority=2)
+        async with scheduler.slot('build', 'hepwiki'):
+            ...
+    """
+
+    def __init__(self, slots, max_lag=1.):
+        self.capacity = dict(slots)
+        self.max_lag = max_lag
+        self.in_use = {resource: 0 for resource in slots}
+        self.waiting = {resource: [] for resource in slots} # heap of (tag, seq, repo, future)
+        self.vtime = {resource: 0. for resource in slots} # virtual time: start tag of the last request served
+        self.repo_vtime = {resource: {} for resource in slots} # finish tag of the last request of each repository
+        self.priority = {}
+        self.n_granted = {}
+        self._seq = itertools.count()
+
+    def register(self, repo, priority=1):
+        self.priority[repo] = priority
+        self.n_granted.setdefault(repo, {resource: 0 for resource in self.capacity})
+
+    def _grant(self, resource, repo, tag):
+        self.in_use[resource] += 1
+        self.vtime[resource] = max(self.vtime[resource], tag)
+        self.n_granted.setdefault(repo, {r: 0 for r in self.capacity})[resource] += 1
+
+    def _release(self, resource):
+        self.in_use[resource] -= 1
+        heap = self.waiting[resource]
+        while heap and self.in_use[resource] < self.capacity[resource]:
+            tag, _, repo, fut = heapq.heappop(heap)
+            if fut.cancelled():
+                continue
+            self._grant(resource, repo, tag)
+            fut.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, resource, repo):
+        ## Start tag of this request, and finish tag of the repository, set on arrival so that the queued
+        ## requests of a repository are spaced by 1/priority. A repository keeps up to 'max_lag' of credit
+        ## behind the virtual time: a repository with one request at a time (e.g. a build) would otherwise lose
+        ## its share each time another repository is served while it is between two requests
+        tag = max(self.vtime[resource] - self.max_lag, self.repo_vtime[resource].get(repo, 0.))
+        self.repo_vtime[resource][repo] = tag + 1. / self.priority.get(repo, 1)
+        if self.in_use[resource] < self.capacity[resource] and not self.waiting[resource]:
+            self._grant(resource, repo, tag)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting[resource], (tag, next(self._seq), repo, fut))
+            _logger.debug(f"'{repo}' waits for a '{resource}' slot")
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled(): # granted right before the cancellation: give it back
+                    self._release(resource)
+                raise
+        try:
+            yield
+        finally:
+            self._release(resource)
+
+    def stats(self):
+        return {
+            'in_use': dict(self.in_use),
+            'waiting': {resource: len(heap) for resource, heap in self.waiting.items()},
+            'granted': {repo: dict(n) for repo, n in self.n_granted.items()},
+        }
@@ -0,0 +1,397 @@
+"""Bilingual full-text search over the wiki. The index is maintained incrementally by the TestMonitor from the
+diff tree of each cycle, stored in one compact file, and queried through a memory map by the SearchServer.
+Chinese is tokenized into character bigrams, English words are lowercased and stemmed.
+
+File layout (little-endian):
+    header   b'HWSI', version u32, n_docs u32, n_terms u32, commit (40 bytes, ascii)
+    docs     n_docs x (path offset u32, title offset u32) into the string blob
+    terms    n_terms x (term offset u32, postings offset u32, df u32), sorted by term
+    strings  blob of u16-length-prefixed utf-8 strings
+    postings per term: df x (doc id delta varint, tf varint)
+"""
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from logger import _logger
+from externalprocess import ExternalProcess
+from gitutils import get_diff_tree
+
+MAGIC, VERSION = b'HWSI', 1
+HEADER = struct.Struct('<4sIII40s')
+DOC = struct.Struct('<II')
+TERM = struct.Struct('<III')
+RGX_TOKEN = re.compile('[\u4e00-\u9fff]+|[a-z0-9]+')
+
+## ================================================================================
+## Tokenizer
+## ================================================================================
+STEP2 = [
+    ('ational', 'ate'), ('tional', 'tion'), ('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate'), ('iveness', 'ive'),
+    ('fulness', 'ful'), ('ousness', 'ous'), ('alism', 'al'), ('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble'),
+    ('ement', ''), ('ment', ''), ('ness', ''), ('ence', ''), ('ance', ''), ('able', ''), ('ible', ''), ('ical', 'ic'),
+]
+
+def stem(word):
+    """A light Porter-style stemmer: plurals, -ed/-ing, and the common derivational suffixes"""
+    if len(word) <= 3 or not word.isalpha():
+        return word
+    if word.endswith('sses') or word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith('ss') and not word.endswith('us'):
+        word = word[:-1]
+    for suffix in ('eed', 'ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            base = word[:-len(suffix)]
+            if suffix == 'eed':
+                word = base + 'ee'
+            elif re.search('[aeiouy]', base):
+                word = base
+                if word[-1] == word[-2] and word[-1] not in 'lsz': # running -> run
+                    word = word[:-1]
+                elif word.endswith(('at', 'bl', 'iz')): # generated -> generate
+                    word += 'e'
+            break
+    if word.endswith('y') and len(word) > 3 and word[-2] not in 'aeiou':
+        word = word[:-1] + 'i'
+    for suffix, repl in STEP2:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)] + repl
+            break
+    if word.endswith('e') and len(word) > 4 and not word.endswith('ee'):
+        word = word[:-1]
+    return word
+
+def tokenize(text):
+    """Chinese runs give their character bigrams (a single character if alone), English words their stem"""
+    tokens = []
+    for run in RGX_TOKEN.findall(text.lower()):
+        if '\u4e00' <= run[0] <= '\u9fff':
+            tokens += [run] if len(run) == 1 else [run[i:i+2] for i in range(len(run) - 1)]
+        else:
+            tokens.append(stem(run))
+    return tokens
+
+def get_title(text):
+    for line in text.split('\n'):
+        if line.startswith('# '):
+            return line[2:].strip()
+    return ''
+
+def is_indexed(fpath):
+    return fpath.endswith('.md') and fpath.split('/')[0] in ('en', 'zh-hans') and not fpath.endswith('/SUMMARY.md')
+
+## ================================================================================
+## Varints
+## ================================================================================
+def write_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def read_varint(data, pos):
+    n, shift = 0, 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+## ================================================================================
+## Writer: kept in memory by the TestMonitor, saved as a whole after each update
+## ================================================================================
+def read_blobs(path, commit, fpaths):
+    """Contents of the files at 'commit', in one 'git cat-file --batch' call. The working tree may change meanwhile"""
+    if len(fpaths) == 0:
+        return {}
+    p = subprocess.run(
+        f'cd {path} && git cat-file --batch', shell=True, input=''.join(f'{commit}:{fpath}\n' for fpath in fpaths).encode(),
+        stdout=subprocess.PIPE, check=True, timeout=600,
+    )
+    out, pos, result = p.stdout, 0, {}
+    for fpath in fpaths:
+        eol = out.index(b'\n', pos)
+        header = out[pos:eol].split()
+        pos = eol + 1
+        if header[-1] == b'missing':
+            continue
+        size = int(header[2])
+        result[fpath] = out[pos:pos+size].decode('utf-8', errors='replace')
+        pos += size + 1
+    return result
+
+
+class SearchIndex(object):
+    """Incrementally maintained inverted index of the wiki pages"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.commit = None
+        self.docs = {}     # path -> title
+        self.postings = {} # term -> {path: tf}
+        self.forward = {}  # path -> [term, ...]
+        if os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        reader = IndexReader(self.filename)
+        self.commit = reader.commit or None
+        self.docs = {reader.doc(i)[0]: reader.doc(i)[1] for i in range(reader.n_docs)}
+        for term, plist in reader.items():
+            self.postings[term] = {reader.doc(i)[0]: tf for i, tf in plist}
+            for i, _ in plist:
+                self.forward.setdefault(reader.doc(i)[0], []).append(term)
+        reader.close()
+
+    def remove_doc(self, fpath):
+        for term in self.forward.pop(fpath, []):
+            plist = self.postings[term]
+            plist.pop(fpath, None)
+            if len(plist) == 0:
+                del self.postings[term]
+        self.docs.pop(fpath, None)
+
+    def add_doc(self, fpath, text):
+        self.remove_doc(fpath)
+        tf = {}
+        for token in tokenize(text):
+            tf[token] = tf.get(token, 0) + 1
+        for term, n in tf.items():
+            self.postings.setdefault(term, {})[fpath] = n
+        self.forward[fpath] = list(tf)
+        self.docs[fpath] = get_title(text)
+
+    def update(self, path, commit):
+        """Bring the index to 'commit' of the repo at 'path', re-indexing only the files changed since the indexed commit"""
+        if commit == self.commit:
+            return 0
+        changed, removed = [], []
+        diff_tree = None
+        if self.commit is not None:
+            try:
+                diff_tree = get_diff_tree(path=path, commit_id=f'{self.commit}..{commit}')
+            except subprocess.CalledProcessError: # e.g. the indexed commit is gone after a force push
+                _logger.warning(f'Cannot diff the search index commit {self.commit[:8]}. Rebuild the index')
+        if diff_tree is None:
+            self.docs, self.postings, self.forward = {}, {}, {}
+            out = subprocess.check_output(f'cd {path} && git ls-tree -r --name-only {commit} -- en zh-hans', shell=True, universal_newlines=True)
+            changed = [fpath for fpath in out.split('\n')[:-1] if is_indexed(fpath)]
+        else:
+            for line in diff_tree: # e.g. ['M', 'en/a.md'], ['R100', 'en/a.md', 'en/b.md']
+                if line[0][0] in ('D', 'R'):
+                    removed.append(line[1])
+                if line[0][0] != 'D':
+                    changed.append(line[-1])
+        for fpath in removed:
+            self.remove_doc(fpath)
+        changed = [fpath for fpath in changed if is_indexed(fpath)]
+        for fpath, text in read_blobs(path, commit, changed).items():
+            self.add_doc(fpath, text)
+        self.commit = commit
+        self.save()
+        return len(changed) + len(removed)
+
+    def save(self):
+        """Write the compact file, then atomically replace the previous one (readers keep their map until they reopen)"""
+        paths = sorted(self.docs)
+        doc_id = {fpath: i for i, fpath in enumerate(paths)}
+        terms = sorted(self.postings)
+        strings, string_offset = bytearray(), {}
+        def add_string(s):
+            if s not in string_offset:
+                data = s.encode()[:0xffff]
+                string_offset[s] = len(strings)
+                strings.extend(struct.pack('<H', len(data)) + data)
+            return string_offset[s]
+        docs = b''.join(DOC.pack(add_string(fpath), add_string(self.docs[fpath])) for fpath in paths)
+        postings, term_table = bytearray(), bytearray()
+        for term in terms:
+            plist = sorted((doc_id[fpath], tf) for fpath, tf in self.postings[term].items())
+            term_table += TERM.pack(add_string(term), len(postings), len(plist))
+            prev = 0
+            for i, tf in plist:
+                write_varint(postings, i - prev)
+                write_varint(postings, tf)
+                prev = i
+        header = HEADER.pack(MAGIC, VERSION, len(paths), len(terms), (self.commit or '').encode().ljust(40, b'\0'))
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as fw:
+            fw.write(header + docs + term_table + struct.pack('<I', len(strings)) + strings + postings)
+        os.replace(tmp, self.filename)
+
+## ================================================================================
+## Reader: queries the memory-mapped file, without loading it
+## ================================================================================
+class IndexReader(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_docs, self.n_terms, commit = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError(f'Not a search index (version {VERSION}): {filename}')
+        self.commit = commit.rstrip(b'\0').decode()
+        self.docs_at = HEADER.size
+        self.terms_at = self.docs_at + self.n_docs * DOC.size
+        n_strings, = struct.unpack_from('<I', self.data, self.terms_at + self.n_terms * TERM.size)
+        self.strings_at = self.terms_at + self.n_terms * TERM.size + 4
+        self.postings_at = self.strings_at + n_strings
+
+    def close(self):
+        self.data.close()
+
+    def changed(self):
+        """Whether the file was replaced since it was mapped"""
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return (st.st_ino, st.st_mtime_ns) != (self.stat.st_ino, self.stat.st_mtime_ns)
+
+    def string(self, offset):
+        pos = self.strings_at + offset
+        n, = struct.unpack_from('<H', self.data, pos)
+        return self.data[pos+2:pos+2+n].decode()
+
+    def doc(self, i):
+        path_at, title_at = DOC.unpack_from(self.data, self.docs_at + i * DOC.size)
+        return self.string(path_at), self.string(title_at)
+
+    def term(self, i):
+        return TERM.unpack_from(self.data, self.terms_at + i * TERM.size)
+
+    def postings(self, i):
+        _, pos, df = self.term(i)
+        pos += self.postings_at
+        result, doc_id = [], 0
+        for _ in range(df):
+            delta, pos = read_varint(self.data, pos)
+            tf, pos = read_varint(self.data, pos)
+            doc_id += delta
+            result.append((doc_id, tf))
+        return result
+
+    def find(self, term):
+        """Binary search over the sorted term table"""
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(self.term(mid)[0]) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and self.string(self.term(lo)[0]) == term:
+            return lo
+        return None
+
+    def items(self):
+        for i in range(self.n_terms):
+            yield self.string(self.term(i)[0]), self.postings(i)
+
+    def search(self, query, lang=None, n=10):
+        """Pages containing all the query tokens, ranked by tf-idf. 'lang' is 'en' or 'zh' to restrict the results"""
+        scores = None
+        for token in set(tokenize(query)):
+            i = self.find(token)
+            if i is None:
+                return []
+            plist = self.postings(i)
+            idf = math.log(1 + self.n_docs / len(plist))
+            token_scores = {doc_id: (1 + math.log(tf)) * idf for doc_id, tf in plist}
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {doc_id: s + token_scores[doc_id] for doc_id, s in scores.items() if doc_id in token_scores}
+        if not scores:
+            return []
+        prefix = {'en': 'en/', 'zh': 'zh-hans/'}.get(lang, '')
+        results = []
+        for doc_id, score in sorted(scores.items(), key=lambda x: -x[1]):
+            fpath, title = self.doc(doc_id)
+            if fpath.startswith(prefix):
+                results.append({'path': fpath, 'title': title, 'score': round(score, 4)})
+                if len(results) == n:
+                    break
+        return results
+
+## ================================================================================
+## Query endpoint
+## ================================================================================
+def index_file(args):
+    return os.path.join(args['bot'].get('state_dir', '.'), '.search_index')
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/search':
+            return self.reply(404, {'error': 'not found'})
+        params = parse_qs(url.query)
+        try:
+            n = int(params.get('n', [10])[0])
+        except ValueError:
+            n = 0
+        if not 1 <= n <= 100:
+            return self.reply(400, {'error': "'n' must be an integer between 1 and 100"})
+        reader = self.server.reader()
+        if reader is None:
+            return self.reply(503, {'error': 'index not ready'})
+        results = reader.search(params.get('q', [''])[0], lang=params.get('lang', [None])[0], n=n)
+        self.reply(200, {'commit': reader.commit, 'results': results})
+
+    def reply(self, status, body):
+        body = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug('Search: ' + format % args)
+
+
+class SearchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, filename):
+        super(SearchHTTPServer, self).__init__(address, SearchHandler)
+        self.filename = filename
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def reader(self):
+        """The current map of the index, remapped when the TestMonitor has replaced the file"""
+        with self._lock:
+            if (self._reader is None or self._reader.changed()) and os.path.exists(self.filename):
+                self._reader = IndexReader(self.filename) # the old map is released once its queries are done
+            return self._reader
+
+
+class SearchServer(ExternalProcess):
+    """Serve the search endpoint next to the gitbook service: GET /search?q=<query>&lang=<en|zh>&n=<max results>"""
+
+    def __init__(self, args):
+        name = 'search_server' if 'name' not in args else f"search_server-{args['name']}"
+        super(SearchServer, self).__init__(args=args, name=name)
+
+    def keep(self):
+        ## Run super: record pid
+        super(SearchServer, self).keep()
+        configs = self.args['search']
+        server = SearchHTTPServer((configs.get('host', '0.0.0.0'), configs.get('port', 4001)), index_file(self.args))
+        _logger.info(f"Search endpoint listening on port {configs.get('port', 4001)}")
+        server.serve_forever()
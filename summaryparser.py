@@ -1,5 +1,5 @@
 import os, re
-from translator import DeepLTranslator as Translator
+from translator import make_translator
 from logger import _logger
 
 class SummaryParser(object):
@@ -21,9 +21,10 @@ class SummaryParser(object):
             return dir_check['zh-hans'] == dir_check['en'] and stc_check['zh-hans'] == stc_check['en']
 
     @staticmethod
-    def produce_target_summary_patch(path, target_lang, patch):
+    def produce_target_summary_patch(path, target_lang, patch, args=None):
         """If one of zh-hans/SUMMARY.md and en/SUMMARY.md is changed, modify the others
             - patch: a git diff patch (best with -U0 structure) that manifest the changes of one file
+            - args: the bot configs, used to set up the translator
         """
 
         def dual(lang):
@@ -67,7 +68,7 @@ class SummaryParser(object):
         
         ## Do translation if necessary
         if len(trans_list) > 0:
-            trans = Translator(selenium_configs={'http_proxy':'127.0.0.1:8090', 'headless':True}, make_banner=False)
+            trans = make_translator(args, one_shot=True, make_banner=False)
             res_trans = trans.launch(('\n'.join(trans_list)), target_lang=target_lang, source_lang=modif_lang)
             res_trans = trans.post(res_trans)
             res_trans_list = res_trans.split('\n')
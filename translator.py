@@ -1,4 +1,11 @@
+import atexit
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from logger import _logger
+from deeplapi import get_api_client
+from ratelimit import get_guard
+from glossary import get_glossary
 
 class DummyTranslator(object):
     """A dummy translator object that naively returns the input text itself"""
@@ -14,20 +21,56 @@ class DummyTranslator(object):
             text = self.post(text)
         return text
 
+    def available(self):
+        """Whether the translation backend accepts jobs now"""
+        return True
+
+    def warm_up(self):
+        """Prepare the backend (heavy imports, browser launch) off the critical path"""
+        pass
+
+    def close(self):
+        """Release what warm_up prepared (e.g. a prelaunched browser)"""
+        pass
+
     def post(self, text):
         banner = '> Passes a dummy translator\n\n' if self.make_banner else ''
         return banner + fix_broken_mkdown(text)
 
 
+class LatencyTranslator(DummyTranslator):
+    """A dummy translator that injects the latency of a real backend, for replays and benchmarks"""
+
+    def __init__(self, latency=1., latency_per_char=0., **kwargs):
+        super(LatencyTranslator, self).__init__(**kwargs)
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+
+    def launch(self, text, target_lang=None, source_lang=None):
+        import time
+        time.sleep(self.latency + self.latency_per_char * len(text))
+        return super(LatencyTranslator, self).launch(text, target_lang=target_lang, source_lang=source_lang)
+
+
 class DeepLTranslator(DummyTranslator):
     """A DeepL translator object"""
 
-    def __init__(self, use_api=False, selenium_configs={}, **kwargs):
+    def __init__(self, use_api=False, selenium_configs={}, api_configs={}, guard_configs={}, glossary=None, **kwargs):
         super(DeepLTranslator, self).__init__(**kwargs)
+        self.use_api = use_api
+        ## Terms frozen before translation and replaced by their translation afterwards (see glossary.py)
+        self.glossary = glossary
+        ## Rate limiter and circuit breaker shared by all translators using the same backend
+        self.guard = get_guard('deepl-api' if use_api else 'deepl-web', **guard_configs)
         if use_api == True:
-            raise NotImplemented("Sorry but I haven't got chance to subscribe a DeepL API...")
-        ## Will use selenium to mimic the behavior that fetches translation script from DeepL free website
+            ## Use the DeepL HTTP API (see DeepLAPIClient for the available api_configs). The client is shared
+            self.api_client = get_api_client(**api_configs)
+        ## Otherwise will use selenium to mimic the behavior that fetches translation script from DeepL free website
         self.selenium_configs = selenium_configs
+        ## With selenium_configs['prelaunch'], the browser of the next call is launched in advance
+        self._next_driver = None
+        self._driver_lock = threading.Lock()
+        self._closed = False
     
     def launch(self, text, target_lang, source_lang):
         """Takes the text, the targeted language and original language type, then returns the translated text"""
@@ -36,7 +79,7 @@ class DeepLTranslator(DummyTranslator):
         
         if not self.support_mkdown:
             ## Do translation: should preserve the weblink, and avoid '|' bug...
-            text_target = self.launch_selenium(text.replace('/','\/').replace('|','#V#')).replace('#V#', '|')
+            text_target = self.launch_backend(text.replace('|','#V#')).replace('#V#', '|')
         else:
             ## Split the code block env if support_mkdown==True
             import re
@@ -45,12 +88,12 @@ class DeepLTranslator(DummyTranslator):
             cb_idx = list(range(len(cb)))
             text_clean = re.sub(rgx_cb, lambda match: f'#B{str(cb_idx.pop(0)).zfill(5)}#', text)
 
-            text_clean_target = self.launch_selenium(text_clean.replace('/','\/').replace('|','#V#')).replace('#V#', '|')
+            text_clean_target = self.launch_backend(text_clean.replace('|','#V#')).replace('#V#', '|')
             if self.target_lang in []: # translate the code block for specific target lang
                 cb_target = []
                 for block in cb:
                     block_sp = block.split('\n')
-                    block_target = self.launch_selenium('\n'.join(block_sp[1:-1]).replace('/','\/').replace('|','#V#')).replace('#V#', '|')
+                    block_target = self.launch_backend('\n'.join(block_sp[1:-1]).replace('|','#V#')).replace('#V#', '|')
                     block_target = '\n'.join([block_sp[0], block_target, block_sp[-1]])
                     cb_target.append(block_target)
             else:
@@ -65,26 +108,90 @@ class DeepLTranslator(DummyTranslator):
             text_target = self.post(text_target)
         return text_target
 
+    def available(self):
+        return self.guard.available()
 
-    def launch_selenium(self, text):
-        from selenium import webdriver
-        from selenium.webdriver.common.by import By
-        from selenium.webdriver.support.ui import WebDriverWait
-        from selenium.webdriver.support import expected_conditions as EC
-        from urllib.parse import quote
-        import time
+    def launch_backend(self, text):
+        """Send the text to the configured backend (DeepL API or the DeepL website) through the guard.
+        Raises TranslationUnavailable if the backend fails or is paused
+        """
+        if (self.target_lang.lower(), self.source_lang.lower()) not in [('en','zh'), ('zh','en')]:
+            raise RuntimeError('Only en->zh or zh->en translation is supported.')
+        if self.glossary is not None:
+            text = self.glossary.freeze(text, self.source_lang.lower())
+        if self.use_api:
+            text_target = self.guard.call(self.launch_api, text)
+        else:
+            text_target = self.guard.call(lambda t: self.launch_selenium(t.replace('/','\/')), text) # should preserve the weblink
+        if self.glossary is not None:
+            text_target = self.glossary.restore(text_target, self.target_lang.lower())
+        return text_target
+
+    def launch_api(self, text):
+        """Translate via the DeepL HTTP API. Blank-line separated blocks are sent as segments, many per request"""
+        import re
+        _logger.debug(f'Text to be translated: {text}')
+        parts = re.split(r'(\n[ \t]*\n)', text) # keep the separators at odd indices
+        parts[0::2] = self.api_client.translate(parts[0::2], target_lang=self.target_lang.lower(), source_lang=self.source_lang.lower())
+        text_target = ''.join(parts)
+        _logger.debug(f'Translations done (raw): {text_target}')
+        return text_target
+
+    def warm_up(self):
+        if self.use_api:
+            return
+        import selenium.webdriver # the import alone takes seconds
+        if self.selenium_configs.get('prelaunch', False):
+            self.prelaunch()
 
+    def new_driver(self):
+        from selenium import webdriver
         chrome_options = webdriver.ChromeOptions()
         ## Use http_proxy due to inaccessibility to DeepL from node13...
         if 'http_proxy' in self.selenium_configs:
             chrome_options.add_argument('--proxy-server=%s' % self.selenium_configs['http_proxy'])
         if 'headless' in self.selenium_configs and self.selenium_configs['headless']:
             chrome_options.add_argument('--headless')
-        driver = webdriver.Chrome(chrome_options=chrome_options)
+        return webdriver.Chrome(chrome_options=chrome_options)
+
+    def prelaunch(self):
+        """Launch the browser of the next call in background"""
+        with self._driver_lock:
+            if self._next_driver is None and not self._closed:
+                self._next_driver = _driver_pool.submit(self.new_driver)
+                _prelaunching.add(self)
+
+    def close(self):
+        """Quit the prelaunched browser, if any"""
+        with self._driver_lock:
+            future, self._next_driver = self._next_driver, None
+            self._closed = True
+        if future is not None:
+            try:
+                future.result().quit()
+            except Exception as e:
+                _logger.warning(f'Cannot quit the prelaunched browser. Error: {e}')
+
+    def take_driver(self):
+        """The prelaunched browser if any, otherwise a new one"""
+        with self._driver_lock:
+            future, self._next_driver = self._next_driver, None
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                _logger.warning(f'Prelaunched browser failed. Launch a new one. Error: {e}')
+        return self.new_driver()
+
+    def launch_selenium(self, text):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from urllib.parse import quote
+        import time
+
+        driver = self.take_driver()
 
-        if (self.target_lang.lower(), self.source_lang.lower()) not in [('en','zh'), ('zh','en')]:
-            raise RuntimeError('Only en->zh or zh->en translation is supported.')
-        
         ## Preprocess on text
         _logger.debug(f'Text to be translated: {text}')
         quoted_text = quote(text)
@@ -111,6 +218,8 @@ class DeepLTranslator(DummyTranslator):
         _logger.debug(f'Translations done (raw): {text_target}')
         _logger.debug(f'Quitting DeepL...')
         driver.quit()
+        if self.selenium_configs.get('prelaunch', False):
+            self.prelaunch()
 
         return text_target
 
@@ -130,6 +239,35 @@ class DeepLTranslator(DummyTranslator):
         
         return text
 
+## Browsers prelaunched by the DeepL translators, quit at exit. Launched processes end without the atexit handlers:
+## there, the owner closes its translators (see TestMonitor.keep)
+_driver_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prelaunch')
+_prelaunching = weakref.WeakSet()
+
+@atexit.register
+def _close_prelaunched():
+    for translator in list(_prelaunching):
+        translator.close()
+
+def make_translator(args=None, one_shot=False, **kwargs):
+    """Build the translator from the 'translator' section of the bot configs.
+    A one-shot translator (used for a single call) never prelaunches a browser
+    """
+
+    configs = (args or {}).get('translator', {})
+    if configs.get('backend', 'deepl') == 'dummy':
+        return DummyTranslator(**kwargs)
+    if configs.get('backend', 'deepl') == 'latency':
+        return LatencyTranslator(latency=configs.get('latency', 1.), latency_per_char=configs.get('latency_per_char', 0.), **kwargs)
+    return DeepLTranslator(
+        use_api=configs.get('use_api', False),
+        selenium_configs=dict(configs.get('selenium', {'http_proxy':'127.0.0.1:8090', 'headless':True}), **({'prelaunch': False} if one_shot else {})),
+        api_configs=configs.get('api', {}),
+        guard_configs=configs.get('guard', {}),
+        glossary=get_glossary(configs.get('glossary')),
+        **kwargs
+    )
+
 def fix_broken_mkdown(text):
     """Fix some broken markdown syntax"""
 